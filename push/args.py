@@ -3,13 +3,27 @@ import argparse
 import itertools
 import collections
 
+import push.checkpoint
 import push.hosts
+import push.ids
 import push.utils
+import push.topology
+import push.waves
 
 
 __all__ = ["parse_args", "ArgumentError"]
 
 
+# the options that add to a list rather than set a value, by destination
+LIST_OPTIONS = [
+    ("-h", "host_refs"),
+    ("-p", "fetches"),
+    ("-d", "deploys"),
+    ("-rev", "revisions"),
+    ("-c/-r/-k", "deploy_commands"),
+]
+
+
 class MutatingAction(argparse.Action):
     def __init__(self, *args, **kwargs):
         self.type_to_mutate = kwargs.pop("type_to_mutate")
@@ -117,15 +131,24 @@ class ArgumentParser(argparse.ArgumentParser):
         raise ArgumentError(message)
 
 
-def _parse_args(config):
+def _parse_args(config, argv=None):
     parser = ArgumentParser(description="Deploy stuff to servers.",
                             epilog="To deploy all code: push -h apps "
                                    "-pc -dc -r all",
                             add_help=False)
 
-    parser.add_argument("-h", dest="host_refs", metavar="HOST", required=True,
-                        action="append", nargs="+",
-                        help="hosts or groups to execute commands on")
+    parser.add_argument("-h", dest="host_refs", metavar="HOST",
+                        action="append", nargs="+", default=[],
+                        help="hosts, groups or globs to execute commands on. "
+                             "prefix with - to exclude or & to intersect, "
+                             "joined on with commas, e.g. apps,-app-0[1-3]")
+    parser.add_argument("--resume", dest="resume", metavar="PUSH_ID",
+                        action="store", default=None,
+                        help="carry on with an interrupted push, skipping "
+                             "the hosts it finished. its options can be "
+                             "changed by giving them again, except for "
+                             "the ones that add to a list (-h, -p, -d, "
+                             "-rev, -c, -r and -k)")
     parser.add_argument("--sleeptime", dest="sleeptime", nargs="?",
                         type=int, default=config.defaults.sleeptime,
                         metavar="SECONDS",
@@ -139,6 +162,32 @@ def _parse_args(config):
     parser.add_argument("--pauseafter", dest="hosts_before_pause", nargs="?",
                         type=int, metavar="NUMBER", default=1,
                         help="push to NUMBER hosts before pausing")
+    parser.add_argument("--parallel", dest="parallel", nargs="?",
+                        type=int, default=config.defaults.parallel,
+                        metavar="NUMBER",
+                        help="push to up to NUMBER hosts at once")
+    parser.add_argument("--engine", dest="engine",
+                        default=config.defaults.engine,
+                        choices=["threads", "async"],
+                        help="push to hosts in parallel with a thread per "
+                             "host or from a single event loop")
+    parser.add_argument("--max-per-domain", dest="max_per_domain",
+                        nargs="?", type=int,
+                        default=config.defaults.max_per_domain,
+                        metavar="NUMBER",
+                        help="interleave hosts from different failure "
+                             "domains and push to at most NUMBER hosts in "
+                             "each at once")
+    parser.add_argument("--fan-out", dest="fan_out", nargs="?", type=int,
+                        default=config.defaults.fan_out, metavar="NUMBER",
+                        help="fetch from hosts already pushed to instead of "
+                             "origin, with up to NUMBER hosts fetching from "
+                             "each at once")
+    parser.add_argument("--waves", dest="wave_spec", action="store",
+                        nargs="?", metavar="SPEC", default=None,
+                        help="push in waves, e.g. 1,5%%:2,25%%:8,*:16 for one "
+                             "canary host, then 5%% of hosts two at a time, "
+                             "etc.")
     parser.add_argument("--seed", dest="seed", action="store",
                         nargs="?", metavar="WORD", default=None,
                         help="name of push to copy the shuffle-order of")
@@ -148,6 +197,40 @@ def _parse_args(config):
     parser.add_argument("--no-shuffle", dest="shuffle",
                         action="store_false",
                         help="don't shuffle host list")
+    parser.add_argument("--host-logs", dest="host_logs",
+                        default=config.defaults.host_logs,
+                        action="store_true",
+                        help="also log each host's output to its own file")
+    parser.add_argument("--no-host-logs", dest="host_logs",
+                        action="store_false",
+                        help="don't log each host's output separately")
+    parser.add_argument("--trace", dest="trace",
+                        default=config.defaults.trace,
+                        action="store_true",
+                        help="write timings of each phase, host and remote "
+                             "command to a trace file next to the log")
+    parser.add_argument("--no-trace", dest="trace",
+                        action="store_false",
+                        help="don't write a trace file")
+    parser.add_argument("--batch", dest="batch",
+                        default=config.defaults.batch,
+                        action="store_true",
+                        help="send all commands for a host in one go")
+    parser.add_argument("--no-batch", dest="batch",
+                        action="store_false",
+                        help="run each command on a host separately")
+    parser.add_argument("--skip-current", dest="skip_current",
+                        default=config.defaults.skip_current,
+                        action="store_true",
+                        help="don't fetch or deploy to hosts already on the "
+                             "revisions being deployed")
+    parser.add_argument("--no-skip-current", dest="skip_current",
+                        action="store_false",
+                        help="fetch and deploy to every host")
+    parser.add_argument("--dynamic-hosts", dest="dynamic_hosts",
+                        action="store_true", default=False,
+                        help="follow hosts joining and leaving during the "
+                             "push")
     parser.add_argument("--list", dest="list_hosts",
                         action="store_true", default=False,
                         help="print the host list to stdout and exit")
@@ -164,6 +247,11 @@ def _parse_args(config):
     flags_group.add_argument("--no-static", dest="build_static",
                              action="store_false",
                              help="don't build static files")
+    flags_group.add_argument("--no-static-cache", dest="static_cache",
+                             action="store_false",
+                             help="build static files even if they were "
+                                  "built for these revisions before, "
+                                  "replacing the cached build")
     flags_group.add_argument("--no-input", dest="auto_continue",
                              action="store_true",
                              help="don't wait for input after deploy")
@@ -211,16 +299,27 @@ def _parse_args(config):
     if len(sys.argv) == 1:
         parser.print_help()
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 def build_command_line(config, args):
-    "Given a configured environment, build a canonical command line for it."
+    """Given a configured environment, build a canonical command line for it.
+    The command line parses back into the same arguments, so options the
+    config turns on are turned off explicitly when they weren't wanted."""
     components = []
 
+    def add_switch(name):
+        if getattr(args, name):
+            components.append("--" + name.replace("_", "-"))
+        elif getattr(config.defaults, name):
+            components.append("--no-" + name.replace("_", "-"))
+
     components.append("-h")
     components.extend(itertools.chain.from_iterable(args.host_refs))
 
+    if args.resume:
+        components.append("--resume=%s" % args.resume)
+
     if args.start_at:
         components.append("--startat=%s" % args.start_at)
 
@@ -230,6 +329,21 @@ def build_command_line(config, args):
     if args.hosts_before_pause > 1:
         components.append("--pauseafter=%s" % args.hosts_before_pause)
 
+    if args.parallel > 1 or config.defaults.parallel > 1:
+        components.append("--parallel=%d" % args.parallel)
+
+    if args.engine != "threads" or config.defaults.engine != "threads":
+        components.append("--engine=%s" % args.engine)
+
+    if args.max_per_domain or config.defaults.max_per_domain:
+        components.append("--max-per-domain=%d" % args.max_per_domain)
+
+    if args.fan_out or config.defaults.fan_out:
+        components.append("--fan-out=%d" % args.fan_out)
+
+    if args.wave_spec:
+        components.append("--waves=%s" % args.wave_spec)
+
     if args.fetches:
         components.append("-p")
         components.extend(args.fetches)
@@ -262,58 +376,146 @@ def build_command_line(config, args):
     if not args.notify_irc:
         components.append("--no-irc")
 
+    if not args.static_cache:
+        components.append("--no-static-cache")
+
     if args.quiet:
-        components.append("--quiet")
+        components.append("-q")
 
     if args.testing:
         components.append("-t")
 
-    if args.shuffle:
-        components.append("--shuffle")
+    add_switch("shuffle")
 
     if args.seed:
         components.append("--seed=%s" % args.seed)
 
+    add_switch("batch")
+
+    if args.dynamic_hosts:
+        components.append("--dynamic-hosts")
+
+    add_switch("host_logs")
+    add_switch("trace")
+    add_switch("skip_current")
+
     components.append("--sleeptime=%d" % args.sleeptime)
 
     return " ".join(components)
 
 
 def parse_args(config, host_source):
-    args = _parse_args(config)
-
-    # give the push a unique name
-    args.push_id = push.utils.get_random_word(config)
+    argv = sys.argv[1:]
+    args = _parse_args(config, argv)
+
+    args.resumed_from = None
+    if args.resume:
+        try:
+            checkpoint = push.checkpoint.load_checkpoint(
+                config.paths.log_root, args.resume)
+        except ValueError as e:
+            raise ArgumentError("--resume: %s" % e)
+        if not checkpoint:
+            raise ArgumentError('--resume: no checkpoint for push "%s"' %
+                                args.resume)
+
+        # use the interrupted push's options unless they're given again.
+        # ones that add to a list would be added to rather than replaced
+        repeated = [option for option, dest in LIST_OPTIONS
+                    if getattr(args, dest)]
+        if repeated:
+            raise ArgumentError("--resume: %s can't be changed when "
+                                "resuming" % ", ".join(repeated))
+        argv = checkpoint.argv + argv
+        args = _parse_args(config, argv)
+        args.resumed_from = checkpoint
+        args.push_id = checkpoint.push_id
+    else:
+        # give the push a unique name
+        args.push_id = push.ids.make_push_id(config)
+
+    if not args.host_refs:
+        raise ArgumentError("-h: at least one host or alias is required")
 
     # quiet implies autocontinue
     if args.quiet or args.auto_continue:
         args.hosts_before_pause = 0
 
+    if args.parallel < 1:
+        raise ArgumentError("--parallel: must push to at least one host "
+                            "at a time")
+
+    if args.max_per_domain < 0:
+        raise ArgumentError("--max-per-domain: must not be negative")
+
+    if args.fan_out < 0:
+        raise ArgumentError("--fan-out: must not be negative")
+    if args.fan_out and not config.deploy.peer_origin:
+        raise ArgumentError("--fan-out: peer_origin must be set in the "
+                            "[deploy] section of the config")
+
+    if args.wave_spec:
+        try:
+            wave_stages = push.waves.parse_wave_spec(args.wave_spec)
+        except ValueError as e:
+            raise ArgumentError("--waves: %s" % e)
+
+    if args.dynamic_hosts and not host_source.can_watch_hosts:
+        raise ArgumentError("--dynamic-hosts: not supported by the %s host "
+                            "source" % config.hosts.source)
+
     # dereference the host lists
     all_hosts, aliases = push.hosts.get_hosts_and_aliases(config, host_source)
-    args.hosts = []
-    queue = collections.deque(args.host_refs)
-    while queue:
-        host_or_alias = queue.popleft()
-
-        # individual instances of -h append a list to the list. flatten
-        if hasattr(host_or_alias, "__iter__"):
-            queue.extend(host_or_alias)
-            continue
-
-        # backwards compatibility with perl version
-        if " " in host_or_alias:
-            queue.extend(x.strip() for x in host_or_alias.split())
-            continue
-
-        if host_or_alias in all_hosts:
-            args.hosts.append(host_or_alias)
-        elif host_or_alias in aliases:
-            args.hosts.extend(aliases[host_or_alias])
-        else:
-            raise ArgumentError('-h: unknown host or alias "%s"' %
-                                host_or_alias)
+    try:
+        args.hosts, args.host_matcher = push.hosts.select_hosts(
+            itertools.chain.from_iterable(args.host_refs), all_hosts, aliases)
+    except push.hosts.HostLookupError as e:
+        raise ArgumentError("-h: %s" % e)
+
+    if not args.hosts:
+        raise ArgumentError("-h: no hosts selected")
+
+    if args.resumed_from:
+        _resume_host_order(args)
+    else:
+        _order_hosts(args)
+
+    # spread consecutive hosts over failure domains so that pushing to
+    # several at once doesn't take out too much of any one domain
+    args.failure_domains = {}
+    if args.max_per_domain:
+        args.failure_domains = host_source.get_failure_domains(args.hosts)
+        if not args.resumed_from:
+            args.hosts = push.topology.interleave_domains(
+                args.hosts, args.failure_domains)
+
+    # split the host list into waves and push to them in that order
+    args.waves = None
+    if args.wave_spec:
+        seed = args.seed or args.push_id
+        args.waves = push.waves.plan_waves(seed, args.hosts, wave_stages,
+                                           args.parallel)
+        args.hosts = [host for wave in args.waves for host in wave.hosts]
+
+    # build a psuedo-commandline out of args and defaults
+    args.command_line = build_command_line(config, args)
+    args.argv = argv
 
+    return args
+
+
+def _resume_host_order(args):
+    """Pick up where the interrupted push left off, in the same order and
+    with the same revisions."""
+    checkpoint = args.resumed_from
+    args.hosts = checkpoint.remaining_hosts()
+    if not args.hosts:
+        raise ArgumentError('--resume: push "%s" already finished every '
+                            'host' % checkpoint.push_id)
+    args.revisions.update(checkpoint.revisions)
+
+
+def _order_hosts(args):
     # make sure the startat is in the dereferenced host list
     if args.start_at and args.start_at not in args.hosts:
         raise ArgumentError('--startat: host "%s" not in host list.' %
@@ -343,13 +545,11 @@ def parse_args(config, host_source):
             args.hosts = itertools.dropwhile(
                 lambda host: host != args.start_at, args.hosts)
         args.hosts = list(args.hosts)
+        if not args.hosts:
+            raise ArgumentError("--startat/--stopbefore: no hosts left "
+                                "to push to")
 
     # do the shuffle!
     if args.shuffle:
         seed = args.seed or args.push_id
         push.utils.seeded_shuffle(seed, args.hosts)
-
-    # build a psuedo-commandline out of args and defaults
-    args.command_line = build_command_line(config, args)
-
-    return args
@@ -0,0 +1,163 @@
+"""Checkpoints let an interrupted push be resumed with --resume. As the push
+goes, a file next to its log records the host list, the revisions the refs
+were resolved to and each host that's done, one JSON object per line."""
+
+import os
+import glob
+import json
+import Queue
+import atexit
+import threading
+
+
+__all__ = ["Checkpoint", "CheckpointWriter", "load_checkpoint", "register"]
+
+
+class Checkpoint(object):
+    "What an earlier push recorded about its progress."
+
+    def __init__(self, push_id, argv, hosts, revisions, done):
+        self.push_id = push_id
+        self.argv = argv
+        self.hosts = hosts
+        self.revisions = revisions
+        self.done = done
+
+    def remaining_hosts(self):
+        return [host for host in self.hosts if host not in self.done]
+
+
+class CheckpointWriter(object):
+    """Appends records to a checkpoint file from a thread of its own, so that
+    the push never waits for the disk. The records that pile up while one
+    batch is being synced are written and synced together in the next."""
+
+    def __init__(self, path, log):
+        self.log = log
+        self.file = open(path, "a")
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._write_queued,
+                                       name="push-checkpoint")
+        self.thread.daemon = True
+        self.thread.start()
+
+        # make sure nothing's left in the queue however the push ends
+        atexit.register(self.close)
+
+    def write(self, **record):
+        self.queue.put(record)
+
+    def close(self):
+        "Write out everything queued so far and close the file."
+        if not self.thread.is_alive():
+            return
+
+        self.queue.put(None)
+        # join with a timeout so that signals still get through
+        while self.thread.is_alive():
+            self.thread.join(0.1)
+
+    def _write_queued(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            try:
+                for record in batch:
+                    if record is not None:
+                        self.file.write(json.dumps(record, sort_keys=True) +
+                                        "\n")
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except (IOError, OSError), e:
+                self.log.warning("Couldn't write the checkpoint, so this push "
+                                 "can't be resumed: %s", e)
+                self.file.close()
+                return
+
+            if None in batch:
+                self.file.close()
+                return
+
+
+def load_checkpoint(log_root, push_id):
+    """Read the checkpoint of the latest push named push_id. Returns None if
+    there isn't one and raises ValueError if it can't be understood."""
+    paths = sorted(glob.glob(os.path.join(log_root,
+                                          "*-%s.checkpoint" % push_id)))
+    if not paths:
+        return None
+
+    with open(paths[-1], "r") as checkpoint_file:
+        lines = checkpoint_file.readlines()
+
+    header = None
+    revisions = {}
+    done = set()
+    for number, line in enumerate(lines):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            if number == len(lines) - 1:
+                # cut off by a crash mid-write
+                break
+            raise ValueError("corrupt checkpoint %s" % paths[-1])
+
+        if record["type"] == "push":
+            header = record
+        elif record["type"] == "revisions":
+            revisions = record["revisions"]
+        elif record["type"] == "host":
+            done.add(record["host"])
+
+    if header is None:
+        raise ValueError("checkpoint %s has no header" % paths[-1])
+
+    return Checkpoint(header["push_id"], header["argv"],
+                      header["hosts"], revisions, done)
+
+
+def register(config, args, deployer, log):
+    # there's nothing to resume about a dry run
+    if args.testing:
+        return
+
+    checkpoint_path = os.path.splitext(log.log_path)[0] + ".checkpoint"
+    writer = CheckpointWriter(checkpoint_path, log)
+    write = writer.write
+
+    @deployer.push_began
+    def on_push_began(deployer):
+        resumed = args.resumed_from
+        write(type="push", push_id=args.push_id, argv=args.argv,
+              hosts=resumed.hosts if resumed else args.hosts)
+
+        # carry over what the interrupted push got done
+        if resumed:
+            if resumed.revisions:
+                write(type="revisions", revisions=resumed.revisions)
+            for host in resumed.hosts:
+                if host in resumed.done:
+                    write(type="host", host=host)
+
+    @deployer.resolve_refs_ended
+    def on_resolve_refs_ended(deployer):
+        write(type="revisions", revisions=args.revisions)
+
+    # rather than process_host_ended, whose other listeners may abort the
+    # push before this one gets to run
+    @deployer.host_completed
+    def on_host_completed(deployer, host, finished):
+        write(type="host", host=host)
+
+    @deployer.push_ended
+    def on_push_ended(deployer):
+        writer.close()
+
+    @deployer.push_aborted
+    def on_push_aborted(deployer, exception):
+        writer.close()
@@ -5,6 +5,7 @@ import termios
 import signal
 
 import push.deploy
+import push.progress
 
 
 SIGNAL_MESSAGES = {signal.SIGINT: "received SIGINT",
@@ -23,13 +24,16 @@ def read_character():
     return ch
 
 
-def wait_for_input(log, deployer):
+def wait_for_input(log, deployer, unit="host"):
     """Wait for the user's choice of whether or not to continue the push.
-    Return how many hosts to push to before asking again (0 for all)."""
+    Return how many hosts (or waves) to push to before asking again (0 for
+    all)."""
 
-    print >> log, ('Press "x" to abort, "c" to go to the next host, a '
-                   'number from 1-9 to push to that many hosts before '
-                   'pausing again, or "a" to continue automatically.')
+    print >> log, ('Press "x" to abort, "c" to go to the next %s, a '
+                   'number from 1-9 to push to that many %ss before '
+                   'pausing again, or "a" to continue automatically.' %
+                   (unit, unit))
+    log.flush()
 
     while True:
         c = read_character()
@@ -97,19 +101,35 @@ def register(config, args, deployer, log):
     def on_build_static_began(deployer):
         log.notice("Building static files...")
 
+    @deployer.restore_static_build_began
+    def on_restore_static_build_began(deployer):
+        log.notice("Reusing static files built for these revisions...")
+
+    @deployer.probe_revisions_began
+    def on_probe_revisions_began(deployer):
+        log.notice("Checking which revisions hosts are on...")
+
     @deployer.process_host_began
     def on_process_host_began(deployer, host):
         log.notice('Starting host "%s"...', host)
 
     @deployer.process_host_ended
     def on_process_host_ended(deployer, host):
-        host_index = args.hosts.index(host) + 1
-        host_count = len(args.hosts)
-        percentage = int((float(host_index) / host_count) * 100)
-        log.notice('Host "%s" done (%d of %d -- %d%% done).',
-                   host, host_index, host_count, percentage)
-
-        if args.hosts[-1] == host:
+        progress = deployer.progress
+        eta = progress.eta()
+        if eta is not None and progress.remaining:
+            remaining = ", about %s left" % push.progress.format_duration(eta)
+        else:
+            remaining = ""
+        log.notice('Host "%s" done (%d of %d -- %d%% done%s).',
+                   host, progress.finished, progress.total,
+                   progress.percentage, remaining)
+
+    @deployer.process_host_ended.prompt
+    def pause_after_host(deployer, host):
+        # when pushing in waves, pauses happen between waves instead
+        if (args.waves or not deployer.progress.remaining or
+                deployer.stopping.is_set()):
             pass
         elif args.hosts_before_pause == 1:
             args.hosts_before_pause = wait_for_input(log, deployer)
@@ -117,6 +137,27 @@ def register(config, args, deployer, log):
             args.hosts_before_pause -= 1
             sleep_with_countdown(log, args.sleeptime)
 
+    @deployer.process_wave_began
+    def on_process_wave_began(deployer, wave):
+        log.notice("Starting wave %d of %d (%d hosts, %d at a time)...",
+                   wave.number, len(args.waves), len(wave.hosts),
+                   wave.concurrency)
+
+    @deployer.process_wave_ended
+    def on_process_wave_ended(deployer, wave):
+        log.notice("Wave %d of %d done.", wave.number, len(args.waves))
+
+    @deployer.process_wave_ended.prompt
+    def pause_after_wave(deployer, wave):
+        if wave.number == len(args.waves):
+            pass
+        elif args.hosts_before_pause == 1:
+            args.hosts_before_pause = wait_for_input(log, deployer,
+                                                     unit="wave")
+        else:
+            args.hosts_before_pause -= 1
+            sleep_with_countdown(log, args.sleeptime)
+
     @deployer.push_ended
     def on_push_ended(deployer):
         log.notice("*** Push complete! ***")
@@ -130,6 +171,7 @@ def register(config, args, deployer, log):
         log.critical("Encountered error on %s: %s", host, exception)
         print >> log, ('Press "x" to abort, "r" to retry this host, '
             'or "c" to skip to the next host')
+        log.flush()
 
         while True:
             c = read_character()
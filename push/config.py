@@ -92,10 +92,24 @@ def config_section(*args, **kwargs):
 
 @config_section
 class SshConfig(object):
+    def valid_transport(value):
+        if value not in ("paramiko", "openssh"):
+            raise ValueError("invalid transport: %r" % value)
+        return value
+
     user = Option(str)
     key_filename = Option(str, default=None)
     strict_host_key_checking = Option(boolean, default=True)
     timeout = Option(int, default=30)
+    prewarm = Option(int, default=0)
+    pool_size = Option(int, default=4)
+    idle_timeout = Option(int, default=300)
+    keepalive_interval = Option(int, default=30)
+    command_timeout = Option(int, default=0)
+    transport = Option(valid_transport, default="paramiko")
+    control_path = Option(str, default="~/.ssh/push-%r@%h:%p")
+    control_persist = Option(int, default=600)
+    connect_threads = Option(int, default=16)
 
 
 @config_section
@@ -103,12 +117,20 @@ class DeployConfig(object):
     build_host = Option(str)
     deploy_binary = Option(str)
     build_binary = Option(str)
+    # the repos static files are built from, whether deployed or not
+    static_repos = Option(str.split, default=("public",))
+    # where hosts fetch a repo from a peer with --fan-out, e.g.
+    # git://%(host)s/%(repo)s
+    peer_origin = Option(str, default=None)
+    # the build host's name as app hosts know it, if they can fetch from it
+    build_host_peer_name = Option(str, default=None)
 
 
 @config_section
 class PathsConfig(object):
     log_root = Option(str)
     wordlist = Option(str, default="/usr/share/dict/words")
+    cache_root = Option(str, default="~/.cache/push")
 
 
 @config_section
@@ -135,6 +157,21 @@ class HostsConfig(object):
     source = Option(valid_host_source)
 
 
+@config_section(required=False)
+class MetricsConfig(object):
+    def valid_backend(value):
+        if value not in ("statsd", "prometheus"):
+            raise ValueError("invalid metrics backend: %r" % value)
+        return value
+
+    backend = Option(valid_backend)
+    prefix = Option(str, default="push")
+    statsd_host = Option(str, default="localhost")
+    statsd_port = Option(int, default=8125)
+    prometheus_address = Option(str, default="127.0.0.1")
+    prometheus_port = Option(int, default=9473)
+
+
 @config_section(prefix="hosts", required=False)
 class DnsConfig(object):
     domain = Option(str)
@@ -154,8 +191,21 @@ class ZooKeeperConfig(object):
 
 @config_section
 class DefaultsConfig(object):
+    def valid_engine(value):
+        if value not in ("threads", "async"):
+            raise ValueError("invalid engine: %r" % value)
+        return value
+
     sleeptime = Option(int, default=0)
     shuffle = Option(boolean, default=False)
+    parallel = Option(int, default=1)
+    batch = Option(boolean, default=False)
+    engine = Option(valid_engine, default="threads")
+    max_per_domain = Option(int, default=0)
+    host_logs = Option(boolean, default=False)
+    trace = Option(boolean, default=False)
+    skip_current = Option(boolean, default=False)
+    fan_out = Option(int, default=0)
 
 
 def alias_parser(parser):
@@ -1,4 +1,16 @@
+import sys
+import time
+import Queue
+import hashlib
+import functools
+import itertools
+import threading
+import collections
+
 import push.ssh
+import push.engine
+import push.progress
+import push.topology
 
 auto_events = []
 
@@ -12,28 +24,159 @@ class PushAborted(Exception):
         return self.reason
 
 
+# how many background listener calls may be waiting before firing an event
+# blocks, and how long to wait for them to finish when the push is over
+MAX_PENDING_LISTENERS = 1000
+DRAIN_TIMEOUT = 30
+
+# how long to wait for the hosts in progress to finish when a parallel push
+# is interrupted, before shutting down their connections anyway
+WORKER_JOIN_TIMEOUT = 30
+
+# how many hosts to ask for their current revisions at once
+PROBE_CONCURRENCY = 50
+
+
+class BackgroundDispatcher(object):
+    """Calls listeners one at a time, in the order their events fired, from
+    a background thread so that slow ones (e.g. network notifications) don't
+    hold up the push."""
+
+    def __init__(self, log):
+        self.log = log
+        self.queue = Queue.Queue(MAX_PENDING_LISTENERS)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _put(self, item):
+        if not self.thread:
+            with self.lock:
+                if not self.thread:
+                    self.thread = threading.Thread(target=self._run,
+                                                   name="push-listeners")
+                    self.thread.daemon = True
+                    self.thread.start()
+
+        # put with a timeout so that signals still get through
+        while True:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def dispatch(self, listener, args, kwargs):
+        self._put((listener, args, kwargs))
+
+    def drain(self):
+        "Wait (for a while) for the listener calls queued so far to finish."
+        if not self.thread:
+            return
+
+        drained = threading.Event()
+        self._put((drained.set, (), {}))
+        deadline = time.time() + DRAIN_TIMEOUT
+        while not drained.is_set() and time.time() < deadline:
+            drained.wait(0.1)
+
+        if not drained.is_set():
+            self.log.warning("Gave up waiting for %d background listeners.",
+                             self.queue.qsize())
+
+    def _run(self):
+        while True:
+            listener, args, kwargs = self.queue.get()
+            try:
+                listener(*args, **kwargs)
+            except Exception, e:
+                self.log.warning("Error in background listener %s: %s",
+                                 listener.__name__, e)
+
+
 class Event(object):
     """An event that can have an arbitrary number of listeners that get called
-    when the event fires."""
-    def __init__(self, parent):
+    when the event fires. Listeners registered with background() are called
+    through the dispatcher instead of right away, and ones registered with
+    prompt() are called after the others, holding prompt_lock instead of
+    lock. If drain is set, firing the event waits for all background
+    listeners called so far."""
+    def __init__(self, parent, lock=None, dispatcher=None, prompt_lock=None):
         self.parent = parent
         self.listeners = set()
+        self.background_listeners = []
+        self.prompt_listeners = []
+        self.lock = lock or threading.RLock()
+        self.prompt_lock = prompt_lock or PromptLock()
+        self.dispatcher = dispatcher
+        self.drain = False
 
     def register_listener(self, callable):
         self.listeners.add(callable)
         return callable
 
+    def background(self, callable):
+        "Register a listener to be called from the background dispatcher."
+        self.background_listeners.append(callable)
+        return callable
+
+    def prompt(self, callable):
+        """Register a listener that may wait for the user. Other events can
+        still fire (and the push be interrupted) while it waits."""
+        self.prompt_listeners.append(callable)
+        return callable
+
     def fire(self, *args, **kwargs):
-        for listener in self.listeners:
-            listener(self.parent, *args, **kwargs)
+        with self.lock:
+            for listener in self.listeners:
+                listener(self.parent, *args, **kwargs)
+
+            for listener in self.background_listeners:
+                self.dispatcher.dispatch(listener, (self.parent,) + args,
+                                         kwargs)
+
+        if self.prompt_listeners:
+            with self.prompt_lock:
+                for listener in self.prompt_listeners:
+                    listener(self.parent, *args, **kwargs)
+
+        if self.drain and self.dispatcher:
+            self.dispatcher.drain()
 
     __call__ = register_listener
 
 
+class PromptLock(object):
+    """The lock that prompts for the user take turns on. It knows which
+    threads are at (or waiting for) a prompt, as those aren't running any
+    commands and won't be done until someone answers."""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.guard = threading.Lock()
+        self.depths = collections.Counter()
+
+    def __enter__(self):
+        with self.guard:
+            self.depths[threading.current_thread()] += 1
+        self.lock.acquire()
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+        with self.guard:
+            thread = threading.current_thread()
+            self.depths[thread] -= 1
+            if not self.depths[thread]:
+                del self.depths[thread]
+
+    def is_prompting(self, thread):
+        with self.guard:
+            return thread in self.depths
+
+
 def event_wrapped(fn):
     """Wraps a function "fn" and fires the "fn_began" event before entering
     the function, "fn_ended" after succesfully returning, and "fn_aborted"
-    on exception."""
+    on exception. All of them get the function's arguments, which the
+    "fn_aborted" event gets after the exception."""
     began_name = fn.__name__ + "_began"
     ended_name = fn.__name__ + "_ended"
     aborted_name = fn.__name__ + "_aborted"
@@ -44,7 +187,7 @@ def event_wrapped(fn):
         try:
             result = fn(self, *args, **kwargs)
         except Exception, e:
-            getattr(self, aborted_name).fire(e)
+            getattr(self, aborted_name).fire(e, *args, **kwargs)
             raise
         else:
             getattr(self, ended_name).fire(*args, **kwargs)
@@ -53,6 +196,62 @@ def event_wrapped(fn):
     return proxy
 
 
+class HostQueue(object):
+    """The hosts still waiting to be pushed to. Hosts may be added to or
+    removed from the queue from other threads while it's being worked on."""
+
+    def __init__(self, hosts):
+        self.hosts = collections.deque(hosts)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def pop(self, accept=None):
+        """Take the next host off the queue, or return None if it's empty.
+        If accept is given, take the first host for which it returns True
+        instead, or return None if there isn't one."""
+        with self.lock:
+            if not self.hosts:
+                return None
+            if accept is None:
+                return self.hosts.popleft()
+
+            for i, host in enumerate(self.hosts):
+                if accept(host):
+                    del self.hosts[i]
+                    return host
+            return None
+
+    def push_front(self, host):
+        with self.lock:
+            self.hosts.appendleft(host)
+
+    def peek(self, count):
+        with self.lock:
+            return list(itertools.islice(self.hosts, count))
+
+    def extend(self, hosts):
+        with self.lock:
+            self.hosts.extend(hosts)
+
+    def clear(self):
+        "Empty the queue. Returns the hosts that were in it."
+        with self.lock:
+            hosts = list(self.hosts)
+            self.hosts.clear()
+            return hosts
+
+    def discard(self, hosts):
+        "Remove hosts from the queue. Returns the ones that were in it."
+        with self.lock:
+            removed = [host for host in self.hosts if host in hosts]
+            if removed:
+                self.hosts = collections.deque(
+                    host for host in self.hosts if host not in hosts)
+            return removed
+
+
 class Deployer(object):
     def __init__(self, config, args, log, host_source):
         self.config = config
@@ -61,17 +260,139 @@ class Deployer(object):
         self.host_source = host_source
         self.deployer = push.ssh.SshDeployer(config, args, log)
 
+        # all events share one lock so that listeners never run concurrently
+        # when hosts are being processed in parallel
+        self.event_lock = threading.RLock()
+        # and prompts for the user take turns on a lock of their own, so that
+        # an open one doesn't keep every other event (including the push
+        # being aborted) waiting
+        self.prompt_lock = PromptLock()
+        self.stopping = threading.Event()
+        # held while hosts join or leave the push with --dynamic-hosts, which
+        # stops once the last queue has been worked through
+        self.hosts_lock = threading.Lock()
+        self.adding_hosts = True
+        self.domain_limiter = push.topology.DomainLimiter(
+            args.failure_domains, args.max_per_domain)
+        self.fetch_sources = push.topology.PeerSources(args.fan_out)
+        self.progress = push.progress.ProgressTracker(len(args.hosts),
+                                                      args.parallel)
+
+        self.dispatcher = BackgroundDispatcher(log)
         for event_name in auto_events:
-            setattr(self, event_name, Event(self))
+            setattr(self, event_name,
+                    Event(self, self.event_lock, self.dispatcher,
+                          self.prompt_lock))
+
+        # background listeners must be done before push() returns
+        self.push_ended.drain = True
+        self.push_aborted.drain = True
+
+        # fired with (host, commands, connect_time, exec_time, output_size)
+        # after each remote invocation
+        self.remote_command_timed = Event(self, self.event_lock,
+                                          self.dispatcher)
+        self.deployer.command_timed = self.remote_command_timed.fire
+
+        # fired with (host, number of hosts finished by then) as soon as a
+        # host is done, before any of the process_host_ended listeners (some
+        # of which may abort the push)
+        self.host_completed = Event(self, self.event_lock, self.dispatcher)
+
+        # the repos each host already has at the revision being deployed,
+        # filled in by probe_revisions with --skip-current
+        self.current_repos = {}
+
+        # (status code, output) of the build host queries run so far
+        self.build_answers = {}
+
+    def _fetch_origin(self, repo, source):
+        "Where to fetch repo from: origin, or the peer host source."
+        if source is None:
+            return "origin"
+        return self.config.deploy.peer_origin % dict(host=source, repo=repo)
+
+    def _fetch_commands(self, host, source=None):
+        # repos already at the right revision needn't be fetched either
+        current = self.current_repos.get(host, ())
+        return [("fetch", repo, self._fetch_origin(repo, source))
+                for repo in self.args.fetches
+                if repo not in current]
+
+    def _deploy_commands(self, host):
+        current = self.current_repos.get(host, ())
+        return [("deploy", repo, self.args.revisions[repo])
+                for repo in self.args.deploys
+                if repo not in current]
+
+    def _host_commands(self, host, fetch=True):
+        "All of the commands to run on each host, in order."
+        commands = self._fetch_commands(host) if fetch else []
+        commands.extend(self._deploy_commands(host))
+        commands.extend(tuple(command)
+                        for command in self.args.deploy_commands)
+        return commands
+
+    def _run_fetch_on_host(self, host, source=None):
+        self._run_fetch_commands(host, self._fetch_commands(host, source))
+
+    def _run_fetch_commands(self, host, commands):
+        if self.args.batch:
+            self.deployer.run_deploy_commands(host, commands)
+        else:
+            for command in commands:
+                self.deployer.run_deploy_command(host, *command)
+
+    def _peer_fetch_steps(self, host):
+        """Generator of the fetches to run on host if a peer is free to fetch
+        from: yields lists of fetch commands, each to be answered with the
+        SshError they failed with or None. When the peer fails, origin is
+        tried next and the peer is only given up on if that works, since
+        otherwise the host itself is probably at fault. If both fail,
+        origin's error is raised."""
+        source = self.fetch_sources.acquire(host)
+        if source is None:
+            return
 
-    def _run_fetch_on_host(self, host, origin="origin"):
-        for repo in self.args.fetches:
-            self.deployer.run_deploy_command(host, "fetch", repo, origin)
+        try:
+            error = yield self._fetch_commands(host, source)
+            if error is None:
+                return
+
+            self.log.warning("Couldn't fetch from %r to %r (%s). fetching "
+                             "from origin instead.", source, host, error)
+            error = yield self._fetch_commands(host)
+            if error is not None:
+                raise error
+            self.fetch_sources.discard(source)
+        finally:
+            self.fetch_sources.release(source)
+
+    def _fetch_from_peer(self, host):
+        """Fetch on host from a host pushed to earlier (or from origin if
+        that fails), if a peer is free. Returns whether it fetched, in which
+        case the fetch from origin isn't needed."""
+        steps = self._peer_fetch_steps(host)
+        try:
+            commands = next(steps)
+        except StopIteration:
+            return False
+
+        while True:
+            try:
+                self._run_fetch_commands(host, commands)
+                error = None
+            except push.ssh.SshError, e:
+                error = e
+
+            try:
+                commands = steps.send(error)
+            except StopIteration:
+                return True
 
     def _deploy_to_host(self, host):
-        for repo in self.args.deploys:
-            self.deployer.run_deploy_command(host, "deploy", repo,
-                                             self.args.revisions[repo])
+        for command in self._deploy_commands(host):
+            self.deployer.run_deploy_command(host, *command)
 
     @event_wrapped
     def synchronize(self):
@@ -80,46 +401,211 @@ class Deployer(object):
 
         self._run_fetch_on_host(self.config.deploy.build_host)
 
+        # the build host now has everything, so it can be the first source
+        # if app hosts know how to reach it (build_host may well be a name
+        # only push can use, like localhost)
+        if self.config.deploy.build_host_peer_name:
+            self.fetch_sources.add(self.config.deploy.build_host_peer_name)
+
+    def _query_build_host(self, queries):
+        """Run build commands (tuples of arguments) that only report on
+        something, all in a single remote invocation, and return a dict of
+        each one's (status code, output). Answers are remembered for the rest
+        of the push so each query only ever goes to the build host once."""
+        pending = [query for query in queries
+                   if query not in self.build_answers]
+        if pending:
+            answers = self.deployer.run_build_commands(pending,
+                                                       display_output=False,
+                                                       keep_going=True)
+            self.build_answers.update(zip(pending, answers))
+        return dict((query, self.build_answers[query]) for query in queries)
+
     @event_wrapped
     def resolve_refs(self):
+        resumed = self.args.resumed_from
+        queries = {}
         for repo in self.args.deploys:
+            if resumed and repo in resumed.revisions:
+                # already resolved by the push being resumed
+                continue
+
             default_ref = self.config.default_refs.get(repo, "origin/master")
             ref_to_deploy = self.args.revisions.get(repo, default_ref)
-            revision = self.deployer.run_build_command("get-revision", repo,
-                                                       ref_to_deploy,
-                                                       display_output=False)
+            queries[repo] = ("get-revision", repo, ref_to_deploy)
+
+        # the static build cache needs to know what the build host has of
+        # the other repos static files are built from, so ask now as well
+        answers = self._query_build_host(queries.values() +
+                                         self._static_input_queries())
+        for repo, query in queries.iteritems():
+            status_code, revision = answers[query]
+            if status_code != 0:
+                raise push.ssh.SshError(status_code)
             self.args.revisions[repo] = revision.strip()
 
     @event_wrapped
     def build_static(self):
         self.deployer.run_build_command("build-static")
 
+    @event_wrapped
+    def restore_static_build(self):
+        self.deployer.run_build_command("restore-static-build",
+                                        self._static_build_key())
+
+    def _static_input_queries(self):
+        """Queries for the build host's revisions of the repos static files
+        are built from that aren't being deployed."""
+        return [("get-revision", repo, "HEAD")
+                for repo in self.config.deploy.static_repos
+                if repo not in self.args.deploys]
+
+    def _static_build_key(self):
+        """Identify the static files that would be built from the revisions
+        the build host now has, or return None if that can't be told."""
+        revisions = dict((repo, self.args.revisions[repo])
+                         for repo in self.args.deploys)
+
+        queries = self._static_input_queries()
+        answers = self._query_build_host(queries)
+        for query in queries:
+            status_code, revision = answers[query]
+            if status_code != 0:
+                return None
+            revisions[query[1]] = revision.strip()
+
+        revisions = "".join("%s=%s\n" % (repo, revisions[repo])
+                            for repo in sorted(revisions))
+        return hashlib.sha1(revisions.encode("utf-8")).hexdigest()
+
+    def _static_build_cached(self, key):
+        # nothing is actually built when testing
+        if self.args.testing:
+            return False
+
+        query = ("has-static-build", key)
+        status_code, output = self._query_build_host([query])[query]
+        return status_code == 0
+
+    def _restore_cached_static_build(self):
+        "Restore the cached static build. Returns whether that worked."
+        try:
+            self.restore_static_build()
+        except push.ssh.SshError, e:
+            # the cache only saves time, so build it the usual way instead
+            self.log.warning("Couldn't restore the cached static build (%s)."
+                             " building it instead.", e)
+            return False
+        return True
+
+    def _save_static_build(self, key):
+        try:
+            self.deployer.run_build_command("save-static-build", key,
+                                            display_output=False)
+        except push.ssh.SshError, e:
+            # the cache only saves time, so don't fail the push over it
+            self.log.warning("Couldn't cache the static build: %s", e)
+
     @event_wrapped
     def deploy_to_build_host(self):
         self._deploy_to_host(self.config.deploy.build_host)
 
     @event_wrapped
     def process_host(self, host):
-        self._run_fetch_on_host(host)
-        self._deploy_to_host(host)
+        self.progress.host_started(host)
+        fetched = self._fetch_from_peer(host)
 
-        for command in self.args.deploy_commands:
-            self.deployer.run_deploy_command(host, *command)
+        if self.args.batch:
+            # send everything (else) to the host in one go
+            self.deployer.run_deploy_commands(
+                host, self._host_commands(host, fetch=not fetched))
+        else:
+            if not fetched:
+                self._run_fetch_on_host(host)
+            self._deploy_to_host(host)
+
+            for command in self.args.deploy_commands:
+                self.deployer.run_deploy_command(host, *command)
 
-    def needs_static_build(self, repo):
+        self.fetch_sources.add(host)
+        self._host_completed(host)
+
+    def _probe_host(self, host):
+        """Coroutine finding out which of the repos being deployed host
+        already has checked out at the revision being deployed."""
+        repos = sorted(self.args.deploys)
         try:
-            self.deployer.run_build_command("needs-static-build", repo,
-                                            display_output=False)
-        except push.ssh.SshError:
-            return False
-        else:
+            answers = yield self.deployer.run_deploy_commands_async(
+                host, [("get-revision", repo) for repo in repos],
+                display_output=False, keep_going=True)
+        except Exception, e:
+            # if in doubt, push to the host as usual
+            self.log.debug("Couldn't get revisions from %s: %s", host, e)
+            return
+
+        current = set(repo for repo, (status_code, revision)
+                      in zip(repos, answers)
+                      if status_code == 0 and
+                      revision.strip() == self.args.revisions[repo])
+
+        # nothing is actually checked out when testing
+        if current and not self.args.testing:
+            self.current_repos[host] = current
+
+    @event_wrapped
+    def probe_revisions(self):
+        """Ask all of the hosts at once which revisions they're on so that
+        hosts which already have what's being deployed can skip fetching and
+        deploying it. Any commands given with -r, -k or -c still run."""
+        loop = push.engine.EventLoop(threads=self.config.ssh.connect_threads,
+                                     poll_interval=push.ssh.POLL_INTERVAL)
+        hosts = collections.deque(self.args.hosts)
+        in_flight = [0]
+
+        def start_probes():
+            while hosts and in_flight[0] < PROBE_CONCURRENCY:
+                in_flight[0] += 1
+                loop.spawn(self._probe_host(hosts.popleft()), probe_finished)
+
+        def probe_finished(exc_info):
+            in_flight[0] -= 1
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            start_probes()
+
+        try:
+            start_probes()
+            loop.run(until=lambda: not in_flight[0] and not hosts)
+        finally:
+            loop.close()
+
+        up_to_date = sum(1 for host in self.args.hosts
+                         if len(self.current_repos.get(host, ())) ==
+                         len(self.args.deploys))
+        self.log.notice("%d of %d hosts already have the revisions being "
+                        "deployed.", up_to_date, len(self.args.hosts))
+
+    def _host_completed(self, host):
+        # under the event lock so that the counts are fired in order
+        with self.event_lock:
+            finished = self.progress.host_completed(host)
+            self.host_completed.fire(host, finished)
+
+    def needs_static_build(self, repos):
+        "Whether deploying any of repos calls for building static files."
+        if "public" in repos:
             return True
 
+        queries = [("needs-static-build", repo) for repo in repos]
+        answers = self._query_build_host(queries)
+        return any(answers[query][0] == 0 for query in queries)
+
     @event_wrapped
     def push(self):
         try:
             self._push()
         finally:
+            self.stopping.set()
             self.deployer.shutdown()
 
 
@@ -143,37 +629,336 @@ class Deployer(object):
             self.deploy_to_build_host()
 
         if self.args.build_static:
-            build_static = False
-            for repo in self.args.deploys:
-                if repo == "public" or self.needs_static_build(repo):
-                    build_static = True
-                    break
-
-            if build_static:
-                self.build_static()
+            # with --no-static-cache the build still replaces what's cached,
+            # which is the point if the cached build is bad
+            static_key = None
+            if self.args.deploys:
+                static_key = self._static_build_key()
+            use_cache = static_key and self.args.static_cache
+
+            # ask about the cache in the same round trip as the rest
+            queries = []
+            if use_cache:
+                queries.append(("has-static-build", static_key))
+            if "public" not in self.args.deploys:
+                queries.extend(("needs-static-build", repo)
+                               for repo in self.args.deploys)
+            self._query_build_host(queries)
+
+            if self.needs_static_build(self.args.deploys):
+                restored = False
+                if use_cache and self._static_build_cached(static_key):
+                    restored = self._restore_cached_static_build()
+
+                if not restored:
+                    self.build_static()
+                    if static_key:
+                        self._save_static_build(static_key)
                 self.args.deploy_commands.append(["fetch-names"])
 
-        i = 0
-        while i < len(self.args.hosts):
-            host = self.args.hosts[i]
-            i += 1
+        if self.args.skip_current and self.args.deploys:
+            self.probe_revisions()
+
+        if self.args.waves:
+            self.host_queues = [HostQueue(wave.hosts)
+                                for wave in self.args.waves]
+        else:
+            self.host_queues = [HostQueue(self.args.hosts)]
+
+        if self.args.dynamic_hosts:
+            self.host_source.watch_hosts(self._on_hosts_changed)
+        self.host_source.prefetch_liveness(self.args.hosts)
+
+        if self.args.waves:
+            for wave in self.args.waves:
+                self.process_wave(wave)
+        else:
+            self._process_hosts(self.host_queues[0], self.args.parallel)
+        self._stop_adding_hosts()
 
+    @event_wrapped
+    def process_wave(self, wave):
+        self._process_hosts(self.host_queues[wave.number - 1],
+                            wave.concurrency)
+
+    def _on_hosts_changed(self, added, removed):
+        """Called by the host source when hosts join or leave while pushing
+        with --dynamic-hosts. Hosts that went away are dropped from the
+        queues before anything tries them and new hosts that match the
+        requested hosts and aliases are added to the end of the push."""
+        with self.hosts_lock:
+            if self.stopping.is_set():
+                return
+
+            removed = set(removed)
+            for queue in self.host_queues:
+                for host in queue.discard(removed):
+                    self.log.warning("Host %r was terminated. skipping it." %
+                                     host)
+                    self.args.hosts.remove(host)
+                    self.progress.add_hosts(-1)
+
+            new_hosts = [host for host in added
+                         if self.args.host_matcher(host) and
+                         host not in self.args.hosts]
+            if not new_hosts:
+                return
+
+            if not self.adding_hosts:
+                for host in new_hosts:
+                    self.log.warning("Host %r joined too late to be pushed "
+                                     "to. skipping it.", host)
+                return
+
+            for host in new_hosts:
+                self.log.notice("Host %r joined. adding it to the push.", host)
+            if self.args.max_per_domain:
+                self.args.failure_domains.update(
+                    self.host_source.get_failure_domains(new_hosts))
+            self.args.hosts.extend(new_hosts)
+            self.progress.add_hosts(len(new_hosts))
+            self.host_queues[-1].extend(new_hosts)
+            self.host_source.prefetch_liveness(new_hosts)
+
+    def _stop_adding_hosts(self):
+        """Stop adding hosts that join to the push, now that the last queue's
+        workers are done. Ones that joined after the workers took their last
+        hosts are left out of it."""
+        with self.hosts_lock:
+            self.adding_hosts = False
+            for host in self.host_queues[-1].clear():
+                self.log.warning("Host %r joined too late to be pushed to. "
+                                 "skipping it.", host)
+                self.args.hosts.remove(host)
+                self.progress.add_hosts(-1)
+
+    def _try_host(self, host):
+        """Process a single host, asking the user what to do if it fails.
+        Returns True if the host should be retried."""
+        try:
+            self.process_host(host)
+        except (push.ssh.SshError, IOError):
+            return self._handle_host_error(host, sys.exc_info())
+        return False
+
+    def _handle_host_error(self, host, exc_info):
+        """Decide what to do about a host that failed with exc_info. Returns
+        True if the host should be retried and re-raises the error if the
+        push should be aborted."""
+        exc_type, error, traceback = exc_info
+        if self.stopping.is_set():
+            raise exc_type, error, traceback
+
+        if self.host_source.should_host_be_alive(host):
+            with self.prompt_lock:
+                response = self.prompt_error(host, error)
+            if response == self.ABORT:
+                raise exc_type, error, traceback
+            elif response == self.RETRY:
+                self.progress.host_retrying(host)
+                return True
+            self.progress.host_failed(host)
+        else:
+            self.log.warning("Host %r appears to have been terminated."
+                             " ignoring errors and continuing." % host)
+            self.progress.host_skipped(host)
+        return False
+
+    def _process_hosts(self, queue, concurrency):
+        self.progress.concurrency = concurrency
+        if self.args.engine == "async":
+            self._process_hosts_async(queue, concurrency)
+        elif concurrency > 1 and len(queue) > 1:
+            self._process_hosts_in_parallel(queue, concurrency)
+        else:
+            self._process_hosts_serially(queue)
+
+    def _process_hosts_serially(self, queue):
+        prewarm = self.config.ssh.prewarm
+        while True:
+            host = queue.pop()
+            if host is None:
+                return
+
+            self.deployer.prewarm_connections(queue.peek(prewarm))
+            while self._try_host(host):
+                # try the same host again
+                pass
+
+    def _process_hosts_in_parallel(self, queue, concurrency):
+        """Process up to "concurrency" hosts at once, each in its own worker
+        thread with its own connection. The first failure that isn't handled
+        by the error prompt stops the workers and is re-raised here."""
+        failures = []
+        prewarm = self.config.ssh.prewarm
+        limiter = self.domain_limiter
+
+        def worker():
+            while not self.stopping.is_set():
+                host = queue.pop(limiter.acquire)
+                if host is None:
+                    if not len(queue):
+                        return
+                    # every remaining host's failure domain is busy
+                    limiter.wait(0.1)
+                    continue
+
+                self.deployer.prewarm_connections(queue.peek(prewarm))
+
+                try:
+                    while self._try_host(host):
+                        if self.stopping.is_set():
+                            return
+                except Exception:
+                    if not self.stopping.is_set():
+                        failures.append(sys.exc_info())
+                    self.stopping.set()
+                    return
+                finally:
+                    limiter.release(host)
+
+        workers = []
+        for i in xrange(min(concurrency, len(queue))):
+            thread = threading.Thread(target=worker, name="push-worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            workers.append(thread)
+
+        try:
+            for thread in workers:
+                # join with a timeout so that signals still reach the main
+                # thread while the workers are running
+                while thread.is_alive():
+                    thread.join(0.1)
+        except:
+            self.stopping.set()
+            self._join_workers(workers)
+            raise
+
+        if failures:
+            exc_type, exc_value, traceback = failures[0]
+            raise exc_type, exc_value, traceback
+
+    def _join_workers(self, workers):
+        """Give the workers a while to finish the hosts they're on once the
+        push is stopping, so their connections aren't shut down under them.
+        Workers at a prompt aren't waited for."""
+        def busy(thread):
+            return (thread.is_alive() and
+                    not self.prompt_lock.is_prompting(thread))
+
+        if any(busy(thread) for thread in workers):
+            self.log.warning("Waiting for the hosts in progress to finish...")
+
+        deadline = time.time() + WORKER_JOIN_TIMEOUT
+        for thread in workers:
+            while busy(thread) and time.time() < deadline:
+                thread.join(0.1)
+
+    def _process_host_async(self, host):
+        "Coroutine doing the same work as process_host on an event loop."
+        self.progress.host_started(host)
+
+        fetched = False
+        steps = self._peer_fetch_steps(host)
+        try:
+            commands = next(steps)
+        except StopIteration:
+            commands = None
+
+        while commands is not None:
             try:
-                self.process_host(host)
-            except (push.ssh.SshError, IOError) as e:
-                if self.host_source.should_host_be_alive(host):
-                    response = self.prompt_error(host, e)
-                    if response == self.ABORT:
-                        raise
-                    elif response == self.CONTINUE:
-                        continue
-                    elif response == self.RETRY:
-                        # rewind one host and try again
-                        i -= 1
-                        continue
+                if self.args.batch:
+                    yield self.deployer.run_deploy_commands_async(host,
+                                                                  commands)
                 else:
-                    self.log.warning("Host %r appears to have been terminated."
-                                     " ignoring errors and continuing." % host)
+                    for command in commands:
+                        yield self.deployer.run_deploy_command_async(
+                            host, *command)
+                error = None
+            except push.ssh.SshError, e:
+                error = e
+
+            try:
+                commands = steps.send(error)
+            except StopIteration:
+                fetched = True
+                commands = None
+
+        commands = self._host_commands(host, fetch=not fetched)
+        if self.args.batch:
+            yield self.deployer.run_deploy_commands_async(host, commands)
+        else:
+            for command in commands:
+                yield self.deployer.run_deploy_command_async(host, *command)
+
+        self.fetch_sources.add(host)
+        self._host_completed(host)
+
+    def _process_hosts_async(self, queue, concurrency):
+        """Process up to "concurrency" hosts at once from a single event loop
+        rather than a thread per host. The process_host events and the error
+        prompt are run from the loop's (main) thread. Like the worker threads,
+        the first failure that isn't handled by the error prompt stops new
+        hosts from being started and is re-raised once the hosts already
+        under way are done."""
+        loop = push.engine.EventLoop(threads=self.config.ssh.connect_threads,
+                                     poll_interval=push.ssh.POLL_INTERVAL)
+        in_flight = [0]
+        failures = []
+        limiter = self.domain_limiter
+
+        def start_hosts():
+            while not self.stopping.is_set() and in_flight[0] < concurrency:
+                host = queue.pop(limiter.acquire)
+                if host is None:
+                    return
+                in_flight[0] += 1
+                self.process_host_began.fire(host)
+                loop.spawn(self._process_host_async(host),
+                           functools.partial(host_finished, host))
+
+        def host_finished(host, exc_info):
+            in_flight[0] -= 1
+            limiter.release(host)
+
+            try:
+                if not exc_info:
+                    self.process_host_ended.fire(host)
+                else:
+                    self.process_host_aborted.fire(exc_info[1], host)
+                    if not isinstance(exc_info[1],
+                                      (push.ssh.SshError, IOError)):
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    if self._handle_host_error(host, exc_info):
+                        queue.push_front(host)
+            except Exception:
+                if not self.stopping.is_set():
+                    failures.append(sys.exc_info())
+                self.stopping.set()
+
+            start_hosts()
+
+        def finished():
+            if self.stopping.is_set():
+                return not in_flight[0]
+            return not in_flight[0] and not len(queue)
+
+        try:
+            start_hosts()
+
+            # hosts may also be added to the queue from elsewhere
+            loop.add_poller(start_hosts)
+            loop.run(until=finished)
+        except:
+            self.stopping.set()
+            raise
+        finally:
+            loop.close()
+
+        if failures:
+            exc_type, exc_value, traceback = failures[0]
+            raise exc_type, exc_value, traceback
 
     def cancel_push(self, reason):
         raise PushAborted(reason)
@@ -0,0 +1,176 @@
+"""A small single-threaded event loop for driving many remote commands at
+once. Work is written as generator-based coroutines which yield operations
+(such as a running remote command) and are resumed with each operation's
+result, or have its exception thrown into them."""
+
+import os
+import sys
+import Queue
+import select
+import threading
+import collections
+
+
+__all__ = ["EventLoop", "Operation", "Result"]
+
+
+class Operation(object):
+    """Something a coroutine can yield to wait on. Subclasses implement run()
+    and eventually call finish() or fail() from the loop's thread."""
+
+    def start(self, loop, callback):
+        self.loop = loop
+        self.callback = callback
+        self.run()
+
+    def run(self):
+        raise NotImplementedError
+
+    def finish(self, result=None):
+        self.loop.call_soon(self.callback, result, None)
+
+    def fail(self, exc_info):
+        self.loop.call_soon(self.callback, None, exc_info)
+
+
+class Result(Operation):
+    "An operation that completes straight away with a known value."
+
+    def __init__(self, value):
+        self.value = value
+
+    def run(self):
+        self.finish(self.value)
+
+
+class _Task(object):
+    def __init__(self, loop, coroutine, callback):
+        self.loop = loop
+        self.coroutine = coroutine
+        self.callback = callback
+
+    def step(self, value, exc_info):
+        try:
+            if exc_info:
+                operation = self.coroutine.throw(*exc_info)
+            else:
+                operation = self.coroutine.send(value)
+        except StopIteration:
+            self.callback(None)
+        except Exception:
+            self.callback(sys.exc_info())
+        else:
+            operation.start(self.loop, self.step)
+
+
+class EventLoop(object):
+    """Multiplexes coroutines over poll(), which unlike select() isn't
+    limited to a thousand or so file descriptors. Blocking work that can't
+    be polled (like connecting) is handed off to a bounded pool of worker
+    threads whose results are delivered back on the loop's thread."""
+
+    def __init__(self, threads, poll_interval):
+        self.max_threads = threads
+        self.poll_interval = poll_interval
+        self.threads = []
+        self.readers = {}
+        self.pollers = set()
+        self.callbacks = collections.deque()
+        self.work = Queue.Queue()
+        self.completed = Queue.Queue()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.poller = select.poll()
+        self.poller.register(self.wakeup_read, select.POLLIN)
+        self.wakeup_lock = threading.Lock()
+        self.closed = False
+
+    def spawn(self, coroutine, callback):
+        """Start running coroutine. callback is called with None when it
+        returns or with exc_info if it raises."""
+        task = _Task(self, coroutine, callback)
+        self.call_soon(task.step, None, None)
+
+    def call_soon(self, fn, *args):
+        self.callbacks.append((fn, args))
+
+    def call_in_thread(self, fn, args, callback):
+        if len(self.threads) < self.max_threads:
+            thread = threading.Thread(target=self._worker,
+                                      name="push-loop-%d" % len(self.threads))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.work.put((fn, args, callback))
+
+    def _worker(self):
+        while True:
+            item = self.work.get()
+            if item is None:
+                return
+
+            fn, args, callback = item
+            try:
+                result, exc_info = fn(*args), None
+            except Exception:
+                result, exc_info = None, sys.exc_info()
+            self.completed.put((callback, result, exc_info))
+
+            with self.wakeup_lock:
+                if self.closed:
+                    return
+                os.write(self.wakeup_write, "x")
+
+    def add_reader(self, fd, callback):
+        "Call callback whenever fd is readable (or hung up)."
+        self.readers[fd] = callback
+        self.poller.register(fd, select.POLLIN)
+
+    def remove_reader(self, fd):
+        if self.readers.pop(fd, None):
+            self.poller.unregister(fd)
+
+    def add_poller(self, callback):
+        "Call callback on every pass through the loop."
+        self.pollers.add(callback)
+
+    def remove_poller(self, callback):
+        self.pollers.discard(callback)
+
+    def run(self, until):
+        "Run the loop until the function until returns True."
+        while True:
+            while self.callbacks:
+                fn, args = self.callbacks.popleft()
+                fn(*args)
+
+            if until():
+                return
+
+            events = self.poller.poll(self.poll_interval * 1000)
+            for fd, event in events:
+                if fd == self.wakeup_read:
+                    os.read(self.wakeup_read, 4096)
+                    continue
+
+                callback = self.readers.get(fd)
+                if callback:
+                    callback()
+
+            while True:
+                try:
+                    callback, result, exc_info = self.completed.get_nowait()
+                except Queue.Empty:
+                    break
+                callback(result, exc_info)
+
+            for poller in list(self.pollers):
+                poller()
+
+    def close(self):
+        for thread in self.threads:
+            self.work.put(None)
+
+        with self.wakeup_lock:
+            self.closed = True
+            os.close(self.wakeup_read)
+            os.close(self.wakeup_write)
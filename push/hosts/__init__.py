@@ -1,3 +1,4 @@
+import bisect
 import fnmatch
 import importlib
 import re
@@ -42,12 +43,31 @@ class HostOrAliasError(Exception):
 
 
 class HostSource(object):
+    # whether watch_hosts is supported
+    can_watch_hosts = False
+
     def get_all_hosts(self):
         raise NotImplementedError
 
+    def watch_hosts(self, callback):
+        """Call callback(added, removed) with lists of host names whenever
+        hosts join or leave after this is called."""
+        raise NotImplementedError
+
     def should_host_be_alive(self, host):
         return True
 
+    def prefetch_liveness(self, hosts):
+        """Optionally start looking up whether hosts should be alive ahead of
+        time so that should_host_be_alive is cheap when it's needed."""
+        pass
+
+    def get_failure_domains(self, hosts):
+        """Optionally return a dict mapping hosts to the failure domain (e.g.
+        availability zone or autoscaling group) they're in. Hosts may be
+        left out if their domain isn't known."""
+        return {}
+
     def shut_down(self):
         pass
 
@@ -59,41 +79,218 @@ def make_host_source(config):
     return source_cls(config)
 
 
-def get_hosts_and_aliases(config, host_source):
-    """Fetches hosts from DNS then aliases them by globs specified in
-    the config file. Returns a tuple of (all_hosts:list, aliases:dict)."""
+def _literal_prefix(glob):
+    "Returns the part of a glob before its first wildcard."
+    match = re.search(r"[*?[]", glob)
+    return glob[:match.start()] if match else glob
 
-    all_hosts = _sorted_nicely(host_source.get_all_hosts())
-    aliases = {}
 
-    def dereference_alias(alias_name, globs, depth=0):
-        if depth > MAX_NESTED_ALIASES:
-            raise HostOrAliasError(alias_name,
-                             "exceeded maximum recursion depth. "
-                             "circular reference?")
-
-        hosts = []
-        for glob in globs:
-            if glob.startswith("@"):
-                # recursive alias reference
-                subalias_name = glob[1:]
-                if subalias_name not in config.aliases:
-                    raise HostOrAliasError(alias_name,
-                                     'referenced undefined alias "%s"',
-                                     subalias_name)
-                subhosts = dereference_alias(subalias_name,
-                                             config.aliases[subalias_name],
-                                             depth=depth + 1)
-                hosts.extend(subhosts)
+class HostIndex(object):
+    """All known hosts, in human-friendly order, indexed so that membership
+    tests are cheap and globs only need to be checked against hosts that
+    share their literal prefix. Glob results are cached."""
+
+    def __init__(self, hosts):
+        self.hosts = _sorted_nicely(hosts)
+        self.positions = dict((host, i) for i, host in enumerate(self.hosts))
+        self.lexical = sorted(self.positions)
+        self.glob_cache = {}
+
+    def __contains__(self, host):
+        return host in self.positions
+
+    def __iter__(self):
+        return iter(self.hosts)
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def match(self, glob):
+        "Returns the hosts matching glob, in human-friendly order."
+        try:
+            return self.glob_cache[glob]
+        except KeyError:
+            pass
+
+        prefix = _literal_prefix(glob)
+        if prefix == glob:
+            matched = [glob] if glob in self.positions else []
+        else:
+            start = bisect.bisect_left(self.lexical, prefix)
+            if prefix:
+                upper = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+                end = bisect.bisect_left(self.lexical, upper)
             else:
-                globbed = fnmatch.filter(all_hosts, glob)
-                if not globbed:
-                    raise HostOrAliasError(alias_name, 'unmatched glob "%s"',
-                                           glob)
-                hosts.extend(globbed)
-        return hosts
+                end = len(self.lexical)
+
+            regex = re.compile(fnmatch.translate(glob))
+            matched = [host for host in self.lexical[start:end]
+                       if regex.match(host)]
+            matched.sort(key=self.positions.get)
+
+        self.glob_cache[glob] = matched
+        return matched
+
+
+class AliasResolver(object):
+    """Dereferences the aliases defined in the config file on demand. Only
+    aliases that are actually used get resolved, and each only once no
+    matter how many other aliases refer to it."""
 
-    for alias, globs in config.aliases.iteritems():
-        aliases[alias] = dereference_alias(alias, globs)
+    def __init__(self, definitions, all_hosts):
+        self.definitions = definitions
+        self.all_hosts = all_hosts
+        self.resolved_hosts = {}
+        self.resolved_globs = {}
+        self.resolving = []
+
+    def __contains__(self, alias_name):
+        return alias_name in self.definitions
+
+    def __getitem__(self, alias_name):
+        return self.hosts(alias_name)
+
+    def _expand(self, alias_name, cache, expand_glob):
+        try:
+            return cache[alias_name]
+        except KeyError:
+            pass
+
+        if (alias_name in self.resolving or
+                len(self.resolving) > MAX_NESTED_ALIASES):
+            raise HostOrAliasError(alias_name,
+                                   "exceeded maximum recursion depth. "
+                                   "circular reference?")
 
+        self.resolving.append(alias_name)
+        try:
+            results = []
+            for glob in self.definitions[alias_name]:
+                if glob.startswith("@"):
+                    # recursive alias reference
+                    subalias_name = glob[1:]
+                    if subalias_name not in self.definitions:
+                        raise HostOrAliasError(alias_name,
+                                         'referenced undefined alias "%s"',
+                                         subalias_name)
+                    results.extend(self._expand(subalias_name, cache,
+                                                expand_glob))
+                else:
+                    results.extend(expand_glob(alias_name, glob))
+        finally:
+            self.resolving.pop()
+
+        cache[alias_name] = results
+        return results
+
+    def _match_glob(self, alias_name, glob):
+        globbed = self.all_hosts.match(glob)
+        if not globbed:
+            raise HostOrAliasError(alias_name, 'unmatched glob "%s"', glob)
+        return globbed
+
+    def hosts(self, alias_name):
+        "Returns the hosts an alias refers to, following nested aliases."
+        return self._expand(alias_name, self.resolved_hosts, self._match_glob)
+
+    def globs(self, alias_name):
+        "Returns the globs an alias refers to, following nested aliases."
+        return self._expand(alias_name, self.resolved_globs,
+                            lambda alias_name, glob: [glob])
+
+
+def get_hosts_and_aliases(config, host_source):
+    """Fetches hosts from the host source and makes the aliases specified
+    in the config file resolvable against them. Returns a tuple of
+    (all_hosts:HostIndex, aliases:AliasResolver)."""
+
+    all_hosts = HostIndex(host_source.get_all_hosts())
+    aliases = AliasResolver(config.aliases, all_hosts)
     return all_hosts, aliases
+
+
+def make_host_matcher(patterns):
+    """Returns a function that says whether a host name matches any of the
+    given host names or globs."""
+    if not patterns:
+        return lambda host: False
+    regex = re.compile("|".join(fnmatch.translate(pattern)
+                                for pattern in patterns))
+    return lambda host: regex.match(host) is not None
+
+
+def _split_selection(refs):
+    """Flattens the host references given on the command line into a list
+    of (operator, reference) terms. References may be separated by spaces
+    (for backwards compatibility with the perl version) or commas and each
+    may be prefixed with "-" to exclude or "&" to intersect with the hosts
+    selected so far."""
+    terms = []
+    for ref in refs:
+        for word in re.split(r"[\s,]+", ref):
+            if not word:
+                continue
+            if word[0] in "-&":
+                operator, word = word[0], word[1:]
+            else:
+                operator = "+"
+            if not word:
+                raise HostLookupError('empty host reference after "%s"' %
+                                      operator)
+            terms.append((operator, word))
+    return terms
+
+
+def select_hosts(refs, all_hosts, aliases):
+    """Evaluates a host selection expression, e.g. "apps,-app-0[1-3]" or
+    "apps &canary", left to right. Each reference is a host, alias or glob
+    and is unioned with, excluded from ("-") or intersected with ("&") the
+    hosts selected so far.
+
+    Returns a tuple of (hosts:list, matcher:function). The hosts are in the
+    order they were first selected with no duplicates. The matcher says
+    whether any host name, even one not known yet, would be selected by
+    the expression."""
+
+    selected = set()
+    listed = set()
+    order = []
+    term_matchers = []
+
+    for operator, ref in _split_selection(refs):
+        if ref in all_hosts:
+            hosts, globs = [ref], [ref]
+        elif ref in aliases:
+            hosts, globs = aliases[ref], aliases.globs(ref)
+        elif _literal_prefix(ref) != ref:
+            hosts, globs = all_hosts.match(ref), [ref]
+            if not hosts:
+                raise HostLookupError('no hosts match "%s"' % ref)
+        else:
+            raise HostLookupError('unknown host or alias "%s"' % ref)
+
+        if operator == "+":
+            selected.update(hosts)
+            for host in hosts:
+                if host not in listed:
+                    listed.add(host)
+                    order.append(host)
+        elif operator == "-":
+            selected.difference_update(hosts)
+        else:
+            selected.intersection_update(hosts)
+
+        term_matchers.append((operator, make_host_matcher(globs)))
+
+    def matcher(host):
+        is_selected = False
+        for operator, matches in term_matchers:
+            if operator == "+":
+                is_selected = is_selected or matches(host)
+            elif operator == "-":
+                is_selected = is_selected and not matches(host)
+            else:
+                is_selected = is_selected and matches(host)
+        return is_selected
+
+    return [host for host in order if host in selected], matcher
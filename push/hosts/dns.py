@@ -1,5 +1,8 @@
 from __future__ import absolute_import
 
+import os
+import json
+
 import dns.name
 import dns.zone
 import dns.query
@@ -7,26 +10,91 @@ import dns.exception
 import dns.resolver
 import dns.rdtypes
 
+import push.utils
 from push.hosts import HostSource, HostLookupError
 
 
+# hosts may declare their failure domain with a TXT record like this
+FAILURE_DOMAIN_PREFIX = "failure-domain="
+
+
 class DnsHostSource(HostSource):
     def __init__(self, config):
         self.domain = config.hosts.dns.domain
+        self.failure_domains = None
+        self.cache_path = os.path.join(
+            os.path.expanduser(config.paths.cache_root),
+            "zone-%s.json" % self.domain)
+
+    def _read_cache(self, serial):
+        """Return the cached host list and failure domains if they were
+        transferred at the given SOA serial, or None if they're missing,
+        stale or unreadable."""
+        try:
+            with open(self.cache_path, "r") as cache_file:
+                cached = json.load(cache_file)
+            if cached["domain"] != self.domain or cached["serial"] != serial:
+                return None
+            hosts = cached["hosts"]
+            if not all(isinstance(host, basestring) for host in hosts):
+                return None
+            failure_domains = dict(cached["failure_domains"])
+            return hosts, failure_domains
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write_cache(self, serial, hosts, failure_domains):
+        cache = json.dumps(dict(domain=self.domain,
+                                serial=serial,
+                                hosts=hosts,
+                                failure_domains=failure_domains))
+        try:
+            push.utils.write_file_atomically(self.cache_path, cache)
+        except (IOError, OSError):
+            # the zone will just be transferred again next time
+            pass
 
     def get_all_hosts(self):
-        """Pull all hosts from DNS by doing a zone transfer."""
+        """Pull all hosts from DNS by doing a zone transfer. The result is
+        cached on disk and reused for as long as the zone's SOA serial stays
+        the same."""
 
         try:
             soa_answer = dns.resolver.query(self.domain, "SOA", tcp=True)
             soa_host = soa_answer[0].mname
+            serial = soa_answer[0].serial
+
+            cached = self._read_cache(serial)
+            if cached is not None:
+                hosts, self.failure_domains = cached
+                return hosts
 
             master_answer = dns.resolver.query(soa_host, "A", tcp=True)
             master_addr = master_answer[0].address
 
             xfr_answer = dns.query.xfr(master_addr, self.domain)
             zone = dns.zone.from_xfr(xfr_answer)
-            return [name.to_text()
-                    for name, ttl, rdata in zone.iterate_rdatas("A")]
+            hosts = [name.to_text()
+                     for name, ttl, rdata in zone.iterate_rdatas("A")]
+
+            failure_domains = {}
+            for name, ttl, rdata in zone.iterate_rdatas("TXT"):
+                for text in rdata.strings:
+                    if text.startswith(FAILURE_DOMAIN_PREFIX):
+                        failure_domains[name.to_text()] = \
+                            text[len(FAILURE_DOMAIN_PREFIX):]
         except dns.exception.DNSException, e:
             raise HostLookupError("host lookup by dns failed: %r" % e)
+
+        self.failure_domains = failure_domains
+        self._write_cache(serial, hosts, failure_domains)
+        return hosts
+
+    def get_failure_domains(self, hosts):
+        """Hosts are in the failure domain given by a "failure-domain=..."
+        TXT record on their name, which comes along with the zone
+        transfer."""
+        if self.failure_domains is None:
+            self.get_all_hosts()
+        return dict((host, self.failure_domains[host]) for host in hosts
+                    if host in self.failure_domains)
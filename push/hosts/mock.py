@@ -7,3 +7,8 @@ class MockHostSource(HostSource):
 
     def get_all_hosts(self):
         return ["app-%02d" % i for i in xrange(self.host_count)]
+
+    def get_failure_domains(self, hosts):
+        # pretend hosts are spread round-robin over three zones
+        return dict((host, "zone-%d" % (int(host[len("app-"):]) % 3))
+                    for host in hosts)
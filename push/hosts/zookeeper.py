@@ -1,4 +1,8 @@
+import functools
+import threading
+
 from kazoo.client import KazooClient
+from kazoo.recipe.watchers import ChildrenWatch
 from kazoo.exceptions import KazooException, NoNodeException
 from kazoo.retry import KazooRetry
 
@@ -6,6 +10,8 @@ from push.hosts import HostSource, HostLookupError
 
 
 class ZookeeperHostSource(HostSource):
+    can_watch_hosts = True
+
     def __init__(self, config):
         self.zk = KazooClient(config.hosts.zookeeper.connection_string)
         self.zk.start()
@@ -13,14 +19,106 @@ class ZookeeperHostSource(HostSource):
                                 config.hosts.zookeeper.password))
         self.zk.add_auth("digest", credentials)
         self.retry = KazooRetry(max_tries=3)
+        self.known_hosts = set()
+        self.liveness = {}
+        self.watchers = {}
+        self.lock = threading.Lock()
 
     def get_all_hosts(self):
         try:
-            return self.retry(self.zk.get_children, "/server")
+            hosts = self.retry(self.zk.get_children, "/server")
         except KazooException as e:
             raise HostLookupError("zk host enumeration failed: %r", e)
+        self.known_hosts = set(hosts)
+        return hosts
+
+    def watch_hosts(self, callback):
+        # changes are relative to the list get_all_hosts returned
+        def on_children_changed(children):
+            children = set(children)
+            added = sorted(children - self.known_hosts)
+            removed = sorted(self.known_hosts - children)
+            self.known_hosts = children
+            if added or removed:
+                callback(added, removed)
+
+        ChildrenWatch(self.zk, "/server", on_children_changed)
+
+    def _is_alive(self, state, is_autoscaled, is_running):
+        if state in ("kicking", "unhealthy"):
+            return False
+        return not is_autoscaled or bool(is_running)
+
+    def prefetch_liveness(self, hosts):
+        """Start fetching the liveness of all hosts at once with asynchronous
+        requests. Results are cached and kept up to date with watches, so
+        should_host_be_alive won't need to go to ZooKeeper for them."""
+        for host in set(hosts):
+            self._fetch_liveness(host)
+
+    def _fetch_liveness(self, host):
+        host_root = "/server/" + host
+        with self.lock:
+            watcher = self.watchers.setdefault(
+                host, functools.partial(self._on_liveness_changed, host))
+
+        results = (self.zk.get_async(host_root + "/state", watch=watcher),
+                   self.zk.exists_async(host_root + "/asg", watch=watcher),
+                   self.zk.exists_async(host_root + "/running", watch=watcher))
+        remaining = [len(results)]
+
+        def on_result(result):
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+
+            try:
+                state, is_autoscaled, is_running = [r.get() for r in results]
+                alive = self._is_alive(state[0], is_autoscaled, is_running)
+            except NoNodeException:
+                alive = False
+            except KazooException:
+                # leave it to should_host_be_alive to check synchronously
+                return
+
+            with self.lock:
+                self.liveness[host] = alive
+
+        for result in results:
+            result.rawlink(on_result)
+
+    def _on_liveness_changed(self, host, event):
+        with self.lock:
+            self.liveness.pop(host, None)
+        self._fetch_liveness(host)
+
+    def get_failure_domains(self, hosts):
+        """Autoscaled hosts are in the failure domain named by the contents
+        of their asg node. Look them all up at once."""
+        hosts = set(hosts)
+        results = [(host, self.zk.get_async("/server/%s/asg" % host))
+                   for host in hosts]
+
+        domains = {}
+        for host, result in results:
+            try:
+                data = result.get()[0]
+            except NoNodeException:
+                continue
+            except KazooException as e:
+                raise HostLookupError("zk failure domain lookup failed: %r" % e)
+
+            if data:
+                domains[host] = data.strip()
+        return domains
 
     def should_host_be_alive(self, host_name):
+        with self.lock:
+            alive = self.liveness.get(host_name)
+        if alive is not None:
+            return alive
+
         try:
             host_root = "/server/" + host_name
 
@@ -30,7 +128,7 @@ class ZookeeperHostSource(HostSource):
 
             is_autoscaled = self.retry(self.zk.exists, host_root + "/asg")
             is_running = self.retry(self.zk.exists, host_root + "/running")
-            return not is_autoscaled or is_running
+            return self._is_alive(state, is_autoscaled, is_running)
         except NoNodeException:
             return False
         except KazooException as e:
@@ -0,0 +1,137 @@
+"""Push ids are random words from a wordlist. Rather than seeking around the
+wordlist for a suitable word every time, the offsets of all suitable words
+are kept in an index file in the cache directory which is memory-mapped so
+that picking a word is a single lookup. The index is rebuilt whenever the
+wordlist changes."""
+
+import os
+import mmap
+import random
+import struct
+import hashlib
+
+import push.utils
+import push.config
+
+
+__all__ = ["make_push_id"]
+
+
+INDEX_MAGIC = "PUSHIDX1"
+# magic, wordlist size, wordlist mtime in microseconds, word count
+INDEX_HEADER = struct.Struct("<8sQQQ")
+INDEX_OFFSET = struct.Struct("<Q")
+
+# give up on avoiding collisions with old pushes after this many tries
+MAX_ATTEMPTS = 100
+
+
+def _is_suitable(word):
+    return word.isalpha() and word.islower() and len(word) >= 5
+
+
+class WordIndex(object):
+    "A memory-mapped index of the words in a wordlist suitable for push ids."
+
+    def __init__(self, wordlist_path, index_path):
+        self.wordlist_path = wordlist_path
+        self.index_path = index_path
+        self.index = self._load()
+        self.count = INDEX_HEADER.unpack_from(self.index)[3]
+
+    def _signature(self):
+        stat = os.stat(self.wordlist_path)
+        return stat.st_size, int(stat.st_mtime * 1000000)
+
+    def _load(self):
+        signature = self._signature()
+        try:
+            with open(self.index_path, "rb") as index_file:
+                index = mmap.mmap(index_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return self._rebuild(signature)
+
+        if len(index) < INDEX_HEADER.size:
+            index.close()
+            return self._rebuild(signature)
+
+        magic, size, mtime, count = INDEX_HEADER.unpack_from(index)
+        expected_size = INDEX_HEADER.size + count * INDEX_OFFSET.size
+        if (magic != INDEX_MAGIC or (size, mtime) != signature or
+                len(index) != expected_size):
+            index.close()
+            return self._rebuild(signature)
+        return index
+
+    def _rebuild(self, signature):
+        offsets = []
+        with open(self.wordlist_path, "rb") as wordlist:
+            offset = 0
+            for line in wordlist:
+                try:
+                    word = unicode(line.rstrip("\n"), "utf-8")
+                except UnicodeDecodeError:
+                    word = u""
+                if _is_suitable(word):
+                    offsets.append(INDEX_OFFSET.pack(offset))
+                offset += len(line)
+
+        index = "".join([INDEX_HEADER.pack(INDEX_MAGIC, signature[0],
+                                           signature[1], len(offsets))] +
+                        offsets)
+
+        try:
+            push.utils.write_file_atomically(self.index_path, index)
+        except (IOError, OSError):
+            # it can still be used from memory this time
+            pass
+
+        return index
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        offset = INDEX_OFFSET.unpack_from(
+            self.index, INDEX_HEADER.size + i * INDEX_OFFSET.size)[0]
+        with open(self.wordlist_path, "rb") as wordlist:
+            wordlist.seek(offset)
+            return unicode(wordlist.readline().rstrip("\n"), "utf-8")
+
+
+def get_push_ids_in_use(log_root):
+    """Return the ids of pushes that have logs in log_root. Logs are named
+    "<timestamp>-<push id>.log"."""
+    try:
+        log_names = os.listdir(unicode(log_root))
+    except OSError:
+        return set()
+
+    push_ids = set()
+    for log_name in log_names:
+        if log_name.endswith(".log") and "-" in log_name:
+            push_ids.add(log_name[:-len(".log")].rsplit("-", 1)[1])
+    return push_ids
+
+
+def make_push_id(config):
+    "Pick a random word for the push that no logged push has used yet."
+    wordlist_path = os.path.abspath(config.paths.wordlist)
+    index_name = "wordlist-%s.idx" % hashlib.md5(wordlist_path).hexdigest()
+    index_path = os.path.join(os.path.expanduser(config.paths.cache_root),
+                              index_name)
+
+    words = WordIndex(wordlist_path, index_path)
+    if not words:
+        raise push.config.ConfigurationError("paths", "wordlist",
+                                             "no words suitable for push ids")
+
+    in_use = get_push_ids_in_use(config.paths.log_root)
+    for attempt in xrange(MAX_ATTEMPTS):
+        word = words[random.randrange(len(words))]
+        if word not in in_use:
+            break
+    return word
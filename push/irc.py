@@ -17,29 +17,30 @@ def register(config, args, deployer, log):
                 log.warning("Harold error: %s", e)
         return wrapper
 
-    @deployer.push_began
+    @deployer.push_began.background
     @log_exception_and_continue
     def on_push_began(deployer):
         monitor.begin(getpass.getuser(), args.command_line,
                       log.log_path, len(args.hosts))
 
-    @deployer.process_host_ended
+    # the count is taken when the host is done rather than whenever this
+    # gets to run in the background
+    @deployer.host_completed.background
     @log_exception_and_continue
-    def on_process_host_ended(deployer, host):
-        index = args.hosts.index(host) + 1
-        monitor.progress(host, index)
+    def on_host_completed(deployer, host, finished):
+        monitor.progress(host, finished)
 
-    @deployer.push_ended
+    @deployer.push_ended.background
     @log_exception_and_continue
     def on_push_ended(deployer):
         monitor.end()
 
-    @deployer.push_aborted
+    @deployer.push_aborted.background
     @log_exception_and_continue
     def on_push_aborted(deployer, e):
         monitor.abort(str(e))
 
-    @deployer.prompt_error_began
+    @deployer.prompt_error_began.background
     @log_exception_and_continue
     def on_prompt_error_began(deployer, host, error):
         monitor.error("%s: %s" % (host, error))
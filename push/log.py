@@ -1,11 +1,15 @@
 import os
 import sys
+import time
+import Queue
+import atexit
 import codecs
 import getpass
 import datetime
+import threading
 
 
-__all__ = ["Log", "register"]
+__all__ = ["Log", "HostLog", "register"]
 
 
 RED = 31
@@ -27,31 +31,14 @@ def colorize(text, color, bold):
         return text
 
 
-class Log(object):
-    def __init__(self, config, args):
-        self.args = args
+# written text is flushed to the log files and stdout once it's been waiting
+# this many seconds or this many characters of it have piled up
+FLUSH_INTERVAL = 0.25
+FLUSH_SIZE = 65536
 
-        # generate a unique id for the push
-        self.push_id = args.push_id
 
-        # build the path for the logfile
-        timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%d_%H:%M:%S")
-        log_name = "-".join((timestamp, self.push_id)) + ".log"
-        self.log_path = os.path.join(config.paths.log_root, log_name)
-
-        # open the logfile
-        self.logfile = codecs.open(self.log_path, "w", "utf-8")
-
-    def write(self, text, color=None, bold=False, newline=False, stdout=True):
-        suffix = "\n" if newline else ""
-        self.logfile.write(text + suffix)
-        if stdout:
-            sys.stdout.write(colorize(text, color, bold) + suffix)
-        self.flush()
-
-    def flush(self):
-        self.logfile.flush()
-        sys.stdout.flush()
+class _LogLevels(object):
+    "Convenience methods shared by the log and its per-host views."
 
     def debug(self, message, *args):
         self.write(message % args,
@@ -83,8 +70,164 @@ class Log(object):
                    color=RED,
                    bold=True)
 
+
+class Log(_LogLevels):
+    """The push's log file and terminal output. Writes are queued and done
+    by a background thread which flushes periodically rather than on every
+    write; call flush() to wait for everything written so far to land.
+
+    With --host-logs, output from each host is also written to its own file
+    in a directory next to the main log file."""
+
+    def __init__(self, config, args):
+        self.args = args
+
+        # generate a unique id for the push
+        self.push_id = args.push_id
+
+        # build the path for the logfile
+        timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%d_%H:%M:%S")
+        log_name = "-".join((timestamp, self.push_id)) + ".log"
+        self.log_path = os.path.join(config.paths.log_root, log_name)
+
+        # open the logfile
+        self.logfile = codecs.open(self.log_path, "w", "utf-8")
+
+        self.host_log_root = None
+        self.host_logfiles = {}
+        if args.host_logs:
+            self.host_log_root = os.path.splitext(self.log_path)[0]
+            os.mkdir(self.host_log_root)
+
+        self.queue = Queue.Queue()
+        self.close_lock = threading.Lock()
+        self.closed = False
+        self.writer = threading.Thread(target=self._write_queued,
+                                       name="push-log")
+        self.writer.daemon = True
+        self.writer.start()
+
+        # make sure nothing's left in the queue however the push ends
+        atexit.register(self.close)
+
+    def write(self, text, color=None, bold=False, newline=False, stdout=True,
+              host=None):
+        suffix = "\n" if newline else ""
+        self.queue.put(("write", (text + suffix, color, bold, stdout, host)))
+
+    def flush(self):
+        "Wait until everything written so far is in the log and on stdout."
+        flushed = threading.Event()
+        self.queue.put(("flush", flushed))
+        # wait with a timeout so that signals still get through
+        while not flushed.is_set() and self.writer.is_alive():
+            flushed.wait(0.1)
+
+    def for_host(self, host):
+        "Return a view of the log for writing about or on behalf of host."
+        return HostLog(self, host)
+
+    def _host_logfile(self, host):
+        logfile = self.host_logfiles.get(host)
+        if not logfile:
+            logfile = codecs.open(os.path.join(self.host_log_root,
+                                               host + ".log"), "w", "utf-8")
+            self.host_logfiles[host] = logfile
+        return logfile
+
+    def _write_entry(self, text, color, bold, stdout, host):
+        if isinstance(text, str):
+            text = text.decode("utf-8", "replace")
+
+        self.logfile.write(text)
+        if host and self.host_log_root:
+            self._host_logfile(host).write(text)
+        if stdout:
+            sys.stdout.write(colorize(text, color, bold))
+
+    def _flush_files(self):
+        self.logfile.flush()
+        for logfile in self.host_logfiles.itervalues():
+            logfile.flush()
+        sys.stdout.flush()
+
+    def _report_error(self, error):
+        try:
+            sys.stderr.write("push: couldn't write to the log: %s\n" % error)
+        except Exception:
+            pass
+
+    def _write_queued(self):
+        # nothing may stop this thread before it's closed, or everything
+        # written afterwards would be lost
+        pending = 0
+        deadline = None
+
+        while True:
+            try:
+                if deadline is None:
+                    action, item = self.queue.get()
+                else:
+                    timeout = max(deadline - time.time(), 0)
+                    action, item = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                action, item = "flush", None
+
+            if action == "write":
+                try:
+                    self._write_entry(*item)
+                except Exception, e:
+                    self._report_error(e)
+                pending += len(item[0])
+                if deadline is None:
+                    deadline = time.time() + FLUSH_INTERVAL
+                if pending < FLUSH_SIZE:
+                    continue
+
+            try:
+                self._flush_files()
+            except Exception, e:
+                self._report_error(e)
+            pending = 0
+            deadline = None
+
+            if action == "flush" and item:
+                item.set()
+            elif action == "close":
+                return
+
     def close(self):
+        "Flush anything that's still queued and close the log files."
+        with self.close_lock:
+            if self.closed:
+                return
+            self.closed = True
+
+        self.queue.put(("close", None))
+        while self.writer.is_alive():
+            self.writer.join(0.1)
+
         self.logfile.close()
+        for logfile in self.host_logfiles.itervalues():
+            logfile.close()
+
+
+class HostLog(_LogLevels):
+    """A view of the log for one host. Everything written through it goes
+    to the main log as usual and to the host's own log file if there is
+    one."""
+
+    def __init__(self, log, host):
+        self.log = log
+        self.args = log.args
+        self.host = host
+
+    def write(self, text, color=None, bold=False, newline=False, stdout=True):
+        self.log.write(text, color=color, bold=bold, newline=newline,
+                       stdout=stdout, host=self.host)
+
+    def flush(self):
+        self.log.flush()
 
 
 def register(config, args, deployer, log):
@@ -95,3 +238,18 @@ def register(config, args, deployer, log):
         log.write("Push started by %s at %s "
                   "UTC with args: %s" % (user, time, args.command_line),
                   newline=True, stdout=False)
+
+    def write_summary(outcome):
+        progress = deployer.progress
+        log.write("Push %s: %d of %d hosts done, %d failed, %d skipped." %
+                  (outcome, progress.completed, progress.total,
+                   progress.failed, progress.skipped),
+                  newline=True, stdout=False)
+
+    @deployer.push_ended
+    def on_push_ended(deployer):
+        write_summary("complete")
+
+    @deployer.push_aborted
+    def on_push_aborted(deployer, exception):
+        write_summary("aborted")
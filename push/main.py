@@ -8,6 +8,9 @@ import push.deploy
 import push.syslog
 import push.irc
 import push.cli
+import push.trace
+import push.metrics
+import push.checkpoint
 
 
 def main():
@@ -38,6 +41,9 @@ def main():
         push.syslog.register(config, args, deployer, log)
         push.irc.register(config, args, deployer, log)
         push.cli.register(config, args, deployer, log)
+        push.trace.register(config, args, deployer, log)
+        push.metrics.register(config, args, deployer, log)
+        push.checkpoint.register(config, args, deployer, log)
 
         # go
         try:
@@ -0,0 +1,227 @@
+import re
+import time
+import socket
+import threading
+import collections
+import BaseHTTPServer
+
+
+__all__ = ["register"]
+
+
+# upper bounds in seconds of the buckets durations are counted in
+BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float("inf"))
+
+# the event_wrapped phases whose durations are measured, apart from hosts
+TIMED_PHASES = ("push", "synchronize", "resolve_refs", "deploy_to_build_host",
+                "build_static", "restore_static_build", "probe_revisions",
+                "process_wave")
+
+
+def _command_name(commands):
+    """Name the deploy command(s) run in one remote invocation, e.g. "fetch"
+    or "fetch+deploy+restart" for a batch."""
+    names = []
+    for command in commands:
+        # commands look like "/usr/bin/sudo <binary> <name> <args...>"
+        words = command.split()
+        names.append(words[2] if len(words) > 2 else "unknown")
+    return "+".join(names)
+
+
+class StatsdMetrics(object):
+    "Sends each measurement to a statsd daemon over UDP as it's made."
+
+    def __init__(self, host, port, prefix):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _name(self, name, labels):
+        parts = [self.prefix, name]
+        parts.extend(re.sub(r"[^\w-]", "_", str(value))
+                     for key, value in sorted(labels.iteritems()))
+        return ".".join(parts)
+
+    def _send(self, metric):
+        try:
+            self.socket.sendto(metric, self.address)
+        except socket.error:
+            # metrics are best-effort and must never get in a push's way
+            pass
+
+    def increment(self, name, value=1, **labels):
+        self._send("%s:%d|c" % (self._name(name, labels), value))
+
+    def observe(self, name, seconds, **labels):
+        self._send("%s:%d|ms" % (self._name(name, labels), seconds * 1000))
+
+    def close(self):
+        self.socket.close()
+
+
+class PrometheusMetrics(object):
+    """Accumulates counters and histograms and serves them in Prometheus's
+    text format over HTTP for as long as push is running."""
+
+    def __init__(self, address, port, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(int)
+        self.histograms = {}
+
+        metrics = self
+
+        class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer((address, port),
+                                                MetricsHandler)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name="push-metrics")
+        thread.daemon = True
+        thread.start()
+
+    def _key(self, name, labels):
+        return "%s_%s" % (self.prefix, name), tuple(sorted(labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[self._key(name, labels)] += value
+
+    def observe(self, name, seconds, **labels):
+        with self.lock:
+            key = self._key(name, labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0.]
+
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+
+    def render(self):
+        def format_labels(labels):
+            if not labels:
+                return ""
+            return "{%s}" % ",".join(
+                '%s="%s"' % (key, str(value).replace("\\", "\\\\")
+                                            .replace('"', '\\"')
+                                            .replace("\n", "\\n"))
+                for key, value in labels)
+
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.iteritems()):
+                if name not in typed:
+                    lines.append("# TYPE %s counter" % name)
+                    typed.add(name)
+                lines.append("%s%s %d" % (name, format_labels(labels), value))
+
+            for (name, labels), histogram in sorted(
+                    self.histograms.iteritems()):
+                if name not in typed:
+                    lines.append("# TYPE %s histogram" % name)
+                    typed.add(name)
+                counts, total = histogram
+                for bound, count in zip(BUCKETS, counts):
+                    bound = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append("%s_bucket%s %d" % (
+                        name, format_labels(labels + (("le", bound),)),
+                        count))
+                lines.append("%s_sum%s %r" % (name, format_labels(labels),
+                                              total))
+                lines.append("%s_count%s %d" % (name, format_labels(labels),
+                                                counts[-1]))
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        # keep serving until push exits so the final values can be scraped
+        pass
+
+
+def register(config, args, deployer, log):
+    if "metrics" not in config:
+        return
+
+    if config.metrics.backend == "statsd":
+        metrics = StatsdMetrics(config.metrics.statsd_host,
+                                config.metrics.statsd_port,
+                                config.metrics.prefix)
+    else:
+        try:
+            metrics = PrometheusMetrics(config.metrics.prometheus_address,
+                                        config.metrics.prometheus_port,
+                                        config.metrics.prefix)
+        except socket.error as e:
+            log.warning("Couldn't serve metrics: %s", e)
+            return
+
+    started = {}
+    hosts_started = set()
+
+    def phase_key(phase, args):
+        # the only phase with an argument is process_wave
+        return phase, args[0].number if args else None
+
+    def register_phase(phase):
+        @getattr(deployer, phase + "_began")
+        def on_began(deployer, *args):
+            started[phase_key(phase, args)] = time.time()
+
+        @getattr(deployer, phase + "_ended")
+        def on_ended(deployer, *args):
+            began = started.pop(phase_key(phase, args), None)
+            if began is not None:
+                metrics.observe("phase_seconds", time.time() - began,
+                                phase=phase)
+            if phase == "push":
+                metrics.close()
+
+        @getattr(deployer, phase + "_aborted")
+        def on_aborted(deployer, exception, *args):
+            started.pop(phase_key(phase, args), None)
+            if phase == "push":
+                metrics.close()
+
+    for phase in TIMED_PHASES:
+        register_phase(phase)
+
+    @deployer.process_host_began
+    def on_process_host_began(deployer, host):
+        if host in hosts_started:
+            metrics.increment("hosts_total", result="retried")
+        hosts_started.add(host)
+        started[("process_host", host)] = time.time()
+
+    @deployer.process_host_ended
+    def on_process_host_ended(deployer, host):
+        metrics.increment("hosts_total", result="done")
+        began = started.pop(("process_host", host), None)
+        if began is not None:
+            metrics.observe("host_seconds", time.time() - began)
+
+    @deployer.process_host_aborted
+    def on_process_host_aborted(deployer, exception, host):
+        metrics.increment("hosts_total", result="failed")
+        started.pop(("process_host", host), None)
+
+    @deployer.remote_command_timed
+    def on_remote_command_timed(deployer, host, commands, connect_time,
+                                exec_time, output_size):
+        metrics.observe("ssh_connect_seconds", connect_time)
+        metrics.observe("remote_command_seconds", exec_time,
+                        command=_command_name(commands))
+        metrics.increment("output_bytes_total", output_size)
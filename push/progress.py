@@ -0,0 +1,106 @@
+import time
+import threading
+import collections
+
+
+__all__ = ["ProgressTracker", "format_duration"]
+
+
+# how many of the most recent hosts' durations the ETA is based on
+DURATION_WINDOW = 20
+
+
+def format_duration(seconds):
+    "Format a number of seconds like 1h02m, 3m20s or 45s."
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+    elif seconds >= 60:
+        return "%dm%02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % seconds
+
+
+class ProgressTracker(object):
+    """Counts how many hosts of the push are done, failed or skipped and
+    estimates how long the rest will take from the average duration of the
+    last few hosts and how many are pushed to at once. Safe to update from
+    several threads."""
+
+    def __init__(self, total, concurrency=1):
+        self.lock = threading.Lock()
+        self.total = total
+        self.concurrency = concurrency
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.started = {}
+        self.durations = collections.deque(maxlen=DURATION_WINDOW)
+        self.duration_sum = 0.
+
+    @property
+    def finished(self):
+        return self.completed + self.failed + self.skipped
+
+    @property
+    def remaining(self):
+        return max(self.total - self.finished, 0)
+
+    @property
+    def percentage(self):
+        if not self.total:
+            return 100
+        return int(float(self.finished) / self.total * 100)
+
+    def add_hosts(self, count):
+        "Account for hosts joining (or leaving, if negative) the push."
+        with self.lock:
+            self.total += count
+
+    def host_started(self, host):
+        with self.lock:
+            self.started[host] = time.time()
+
+    def _host_finished(self, host):
+        started = self.started.pop(host, None)
+        if started is None:
+            return
+
+        if len(self.durations) == self.durations.maxlen:
+            self.duration_sum -= self.durations[0]
+        duration = time.time() - started
+        self.durations.append(duration)
+        self.duration_sum += duration
+
+    def host_completed(self, host):
+        "The host is done. Returns how many hosts are finished now."
+        with self.lock:
+            self._host_finished(host)
+            self.completed += 1
+            return self.finished
+
+    def host_failed(self, host):
+        "The host failed and the push moved on without it."
+        with self.lock:
+            self._host_finished(host)
+            self.failed += 1
+
+    def host_skipped(self, host):
+        "The host went away so it was skipped."
+        with self.lock:
+            self.started.pop(host, None)
+            self.skipped += 1
+
+    def host_retrying(self, host):
+        "The host failed and will be tried again from the start."
+        with self.lock:
+            self.started.pop(host, None)
+
+    def eta(self):
+        """Estimate the seconds until the push is done, or None if no host
+        has finished yet."""
+        with self.lock:
+            if not self.durations:
+                return None
+            average = self.duration_sum / len(self.durations)
+            rounds = -(-self.remaining // max(self.concurrency, 1))
+            return average * rounds
@@ -1,7 +1,18 @@
+import os
+import sys
+import time
+import codecs
 import select
+import binascii
+import subprocess
 import getpass
+import threading
+import contextlib
+import collections
 import paramiko
 
+import push.engine
+
 
 # hack to add paramiko support for AES encrypted private keys
 if "AES-128-CBC" not in paramiko.PKey._CIPHER_TABLE:
@@ -9,6 +20,12 @@ if "AES-128-CBC" not in paramiko.PKey._CIPHER_TABLE:
     paramiko.PKey._CIPHER_TABLE["AES-128-CBC"] = dict(cipher=AES, keysize=16, blocksize=16, mode=AES.MODE_CBC)
 
 
+# how much to read from a channel at once, and how long to wait for output
+# before flushing partial lines and checking for timeouts
+READ_SIZE = 32768
+POLL_INTERVAL = 0.5
+
+
 class SshError(Exception):
     def __init__(self, code):
         self.code = code
@@ -17,12 +34,183 @@ class SshError(Exception):
         return "remote command exited with code %d" % self.code
 
 
-class SshConnection(object):
-    def __init__(self, config, log, host):
-        self.config = config
+class SshTimeoutError(SshError):
+    def __init__(self, timeout):
+        SshError.__init__(self, -1)
+        self.timeout = timeout
+
+    def __str__(self):
+        return "remote command timed out after %d seconds" % self.timeout
+
+
+class LineBufferedLogWriter(object):
+    """Collects output and writes it to the log a line at a time rather than
+    once per chunk received."""
+
+    def __init__(self, log):
         self.log = log
+        self.pending = []
+
+    def write(self, text):
+        newline = text.rfind("\n")
+        if newline == -1:
+            self.pending.append(text)
+            return
+
+        self.pending.append(text[:newline + 1])
+        self.log.write("".join(self.pending), newline=False)
+        self.pending = [text[newline + 1:]]
+
+    def flush(self):
+        text = "".join(self.pending)
+        self.pending = []
+        if text:
+            self.log.write(text, newline=False)
+
+
+class _OutputCollector(object):
+    def __init__(self, log, display_output):
+        self.output = []
+        self.size = 0
+        self.display = LineBufferedLogWriter(log) if display_output else None
+
+    def write(self, text):
+        self.output.append(text)
+        self.size += len(text.encode("utf-8"))
+        if self.display:
+            self.display.write(text)
+
+    def flush(self):
+        if self.display:
+            self.display.flush()
+
+    def getvalue(self):
+        return "".join(self.output)
+
+
+class _OutputDecoder(object):
+    "Incrementally decodes UTF-8 output and writes it to output."
+
+    def __init__(self, output):
+        self.output = output
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+
+    def write(self, received):
+        text = self.decoder.decode(received)
+        if text:
+            self.output.write(text)
+
+    def close(self):
+        text = self.decoder.decode("", final=True)
+        if text:
+            self.output.write(text)
+
+
+class _RunningChannel(object):
+    def __init__(self, channel):
+        self.channel = channel
+
+    def fileno(self):
+        return self.channel.fileno()
+
+    def read(self, size):
+        return self.channel.recv(size)
+
+    def wait(self):
+        return self.channel.recv_exit_status()
+
+    def kill(self):
+        self.channel.close()
+
+
+class _RunningProcess(object):
+    def __init__(self, process):
+        self.process = process
+
+    def fileno(self):
+        return self.process.stdout.fileno()
+
+    def read(self, size):
+        return os.read(self.fileno(), size)
+
+    def wait(self):
+        self.process.stdout.close()
+        return self.process.wait()
+
+    def kill(self):
+        self.process.kill()
+        self.process.stdout.close()
+
+
+class RemoteConnection(object):
+    """Base class for the transports commands can be executed over.
+    Subclasses connect to host in their constructor and implement
+    start_command, is_active and close."""
+
+    def __init__(self, config, log, host, keepalive=0):
+        self.config = config
+        self.log = log.for_host(host)
         self.host = host
 
+    def execute_command(self, command, display_output=False):
+        output = _OutputCollector(self.log, display_output)
+        status_code = self.execute_streaming(command, output)
+        if status_code != 0:
+            raise SshError(status_code)
+
+        return output.getvalue()
+
+    def start_command(self, command):
+        """Start running command and return a handle to it without waiting
+        for any output. The handle has fileno(), read(size), wait() and
+        kill() methods."""
+        raise NotImplementedError
+
+    def execute_streaming(self, command, output):
+        """Run command, writing its output to the file-like object output as
+        it arrives. output is flushed whenever the command goes quiet for a
+        moment. Returns the exit status of the command."""
+        running = self.start_command(command)
+        command_timeout = self.config.ssh.command_timeout
+        deadline = time.time() + command_timeout
+        decoder = _OutputDecoder(output)
+
+        try:
+            while True:
+                if command_timeout and time.time() > deadline:
+                    running.kill()
+                    raise SshTimeoutError(command_timeout)
+
+                readable = select.select([running], [], [], POLL_INTERVAL)[0]
+
+                if not readable:
+                    output.flush()
+                    continue
+
+                received = running.read(READ_SIZE)
+                if not received:
+                    break
+
+                decoder.write(received)
+            decoder.close()
+        finally:
+            output.flush()
+
+        return running.wait()
+
+    def is_active(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SshConnection(RemoteConnection):
+    "A connection made with paramiko."
+
+    def __init__(self, config, log, host, keepalive=0):
+        RemoteConnection.__init__(self, config, log, host)
+
         self.client = paramiko.SSHClient()
         if not config.ssh.strict_host_key_checking:
             self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -31,55 +219,414 @@ class SshConnection(object):
                             timeout=config.ssh.timeout,
                             pkey=config.ssh.pkey)
 
-    def execute_command(self, command, display_output=False):
+        if keepalive:
+            self.client.get_transport().set_keepalive(keepalive)
+
+    def start_command(self, command):
         transport = self.client.get_transport()
         channel = transport.open_session()
         channel.settimeout(self.config.ssh.timeout)
         channel.set_combine_stderr(True)
         channel.exec_command(command)
         channel.shutdown_write()
+        return _RunningChannel(channel)
 
-        output = []
-        while True:
-            readable = select.select([channel], [], [])[0]
+    def is_active(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
 
-            if not readable:
-                continue
+    def close(self):
+        self.client.close()
 
-            received = channel.recv(1024)
-            if not received:
-                break
 
-            received = unicode(received, "utf-8")
+class OpenSshConnection(RemoteConnection):
+    """A connection made by running the system's ssh binary. A ControlMaster
+    is set up when connecting and every command is multiplexed over it. The
+    master stays around for control_persist seconds after the last command,
+    so later pushes can reuse it too."""
+
+    def __init__(self, config, log, host, keepalive=0):
+        RemoteConnection.__init__(self, config, log, host)
+        self.closed = False
+
+        ssh = config.ssh
+        self.base_command = [
+            "ssh",
+            "-l", ssh.user,
+            "-o", "BatchMode=yes",
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath=%s" % os.path.expanduser(ssh.control_path),
+            "-o", "ControlPersist=%d" % ssh.control_persist,
+            "-o", "ConnectTimeout=%d" % ssh.timeout,
+            "-o", "StrictHostKeyChecking=%s" % (
+                "yes" if ssh.strict_host_key_checking else "no"),
+        ]
+        if ssh.key_filename:
+            self.base_command.extend(("-i", ssh.key_filename))
+        if keepalive:
+            self.base_command.extend(("-o", "ServerAliveInterval=%d" %
+                                      keepalive))
+
+        # start (or reuse) the master connection now so that connection
+        # failures happen here like they do with other transports
+        with open(os.devnull, "r+") as devnull:
+            process = subprocess.Popen(self.base_command + [host, "true"],
+                                       stdin=devnull, stdout=devnull,
+                                       stderr=subprocess.PIPE)
+            error = process.communicate()[1]
+        if process.returncode != 0:
+            raise IOError("ssh to %s failed: %s" % (host, error.strip()))
+
+    def start_command(self, command):
+        with open(os.devnull, "r") as devnull:
+            process = subprocess.Popen(self.base_command + [self.host, command],
+                                       stdin=devnull,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+        return _RunningProcess(process)
+
+    def is_active(self):
+        # commands re-establish the master themselves if it goes away
+        return not self.closed
+
+    def close(self):
+        # the master is deliberately left running for ControlPersist
+        self.closed = True
+
 
-            output.append(received)
+TRANSPORTS = {
+    "paramiko": SshConnection,
+    "openssh": OpenSshConnection,
+}
 
-            if display_output:
-                self.log.write(received, newline=False)
 
-        status_code = channel.recv_exit_status()
+class CommandScript(object):
+    """A sequence of commands to be run in a single remote invocation. Each
+    command's output is followed by a marker line carrying its exit status,
+    which is used to split the combined output back up per command. The
+    script stops at the first command that fails unless keep_going is set."""
+
+    def __init__(self, log, commands, display_output=True, keep_going=False):
+        self.log = log
+        self.commands = commands
+        self.keep_going = keep_going
+        self.display = LineBufferedLogWriter(log) if display_output else None
+        self.marker = "[push %s] status " % binascii.hexlify(os.urandom(8))
+        self.outputs = []
+        self.statuses = []
+        self.buffer = u""
+        self.size = 0
+
+    def render(self):
+        lines = []
+        for command in self.commands:
+            lines.append(command)
+            lines.append("status=$?")
+            lines.append("printf '%s%%d\\n' $status" % self.marker)
+            if not self.keep_going:
+                lines.append("[ $status -eq 0 ] || exit $status")
+        return "\n".join(lines)
+
+    def start(self):
+        self._begin_command()
+
+    def _begin_command(self):
+        self.flush()
+        self.log.debug(self.commands[len(self.outputs)])
+        self.outputs.append([])
+
+    def _emit(self, text):
+        if not text:
+            return
+
+        self.outputs[-1].append(text)
+        if self.display:
+            self.display.write(text)
+
+    def flush(self):
+        if self.display:
+            self.display.flush()
+
+    def write(self, received):
+        self.buffer += received
+        self.size += len(received.encode("utf-8"))
+
+        while True:
+            start = self.buffer.find(self.marker)
+            if start == -1:
+                break
+            end = self.buffer.find("\n", start + len(self.marker))
+            if end == -1:
+                # wait for the rest of the status line
+                self._emit(self.buffer[:start])
+                self.buffer = self.buffer[start:]
+                return
+
+            self._emit(self.buffer[:start])
+            status = int(self.buffer[start + len(self.marker):end])
+            self.statuses.append(status)
+            self.buffer = self.buffer[end + 1:]
+
+            if ((status == 0 or self.keep_going) and
+                    len(self.outputs) < len(self.commands)):
+                self._begin_command()
+
+        # hold back anything that might be the start of a marker
+        held = min(len(self.marker) - 1, len(self.buffer))
+        while held and not self.buffer.endswith(self.marker[:held]):
+            held -= 1
+        safe = len(self.buffer) - held
+        self._emit(self.buffer[:safe])
+        self.buffer = self.buffer[safe:]
+
+    def finish(self):
+        self._emit(self.buffer)
+        self.buffer = u""
+        self.flush()
+        return ["".join(output) for output in self.outputs]
+
+    def results(self):
+        "Finish up and return (status code, output) pairs for each command."
+        return zip(self.statuses, self.finish())
+
+
+class _AsyncRemoteCommand(push.engine.Operation):
+    """Runs a command on a host from an event loop. Connecting and starting
+    the command happen on one of the loop's threads, then output is read as
+    the loop sees it arrive. Completes with the value of result() or fails
+    with SshError."""
+
+    def __init__(self, deployer, host, command, output, result, commands):
+        self.deployer = deployer
+        self.host = host
+        self.command = command
+        self.output = output
+        self.result = result
+        self.commands = commands
+
+    def run(self):
+        self.loop.call_in_thread(self._start, (), self._started)
+
+    def _start(self):
+        self.started = time.time()
+        checkout = self.deployer._get_connection(self.host)
+        connection = checkout.__enter__()
+        self.connected = time.time()
+        try:
+            return checkout, connection.start_command(self.command)
+        except:
+            checkout.__exit__(*sys.exc_info())
+            raise
+
+    def _started(self, result, exc_info):
+        if exc_info:
+            self.fail(exc_info)
+            return
+
+        self.checkout, self.running = result
+        self.decoder = _OutputDecoder(self.output)
+        self.command_timeout = self.deployer.config.ssh.command_timeout
+        self.deadline = time.time() + self.command_timeout
+        self.loop.add_reader(self.running.fileno(), self._on_readable)
+        self.loop.add_poller(self._on_poll)
+
+    def _on_readable(self):
+        received = self.running.read(READ_SIZE)
+        if received:
+            self.decoder.write(received)
+            return
+
+        self._stop()
+        self.decoder.close()
+        status_code = self.running.wait()
+        self.checkout.__exit__(None, None, None)
+        self.deployer._command_timed(self.host, self.commands, self.started,
+                                     self.connected, self.output.size)
+
+        result = self.result()
         if status_code != 0:
-            raise SshError(status_code)
+            self.fail((SshError, SshError(status_code), None))
+        else:
+            self.finish(result)
 
-        return "".join(output)
+    def _on_poll(self):
+        self.output.flush()
 
-    def close(self):
-        self.client.close()
+        if self.command_timeout and time.time() > self.deadline:
+            self._stop()
+            self.running.kill()
+            self.checkout.__exit__(None, None, None)
+            self.deployer._command_timed(self.host, self.commands,
+                                         self.started, self.connected,
+                                         self.output.size)
+            self.result()
+            error = SshTimeoutError(self.command_timeout)
+            self.fail((SshTimeoutError, error, None))
+
+    def _stop(self):
+        self.loop.remove_reader(self.running.fileno())
+        self.loop.remove_poller(self._on_poll)
+
+
+class _PooledConnection(object):
+    def __init__(self, host):
+        self.host = host
+        self.connection = None
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.users = 0
+        self.last_used = time.time()
+
+    def is_idle(self):
+        return self.ready.is_set() and not self.users
+
+
+class SshConnectionPool(object):
+    """Keeps connections to recently used hosts open and can open connections
+    to hosts that will be needed soon in the background. The least recently
+    used connections are closed when there are more than max_size open, and
+    connections that have not been used for idle_timeout seconds are closed
+    as well."""
+
+    def __init__(self, config, log, connection_class, max_size,
+                 idle_timeout):
+        self.config = config
+        self.log = log
+        self.connection_class = connection_class
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def _connect_in_background(self, entry):
+        try:
+            connection = self.connection_class(self.config, self.log,
+                                               entry.host)
+        except Exception:
+            # the connection will be retried when the host is actually used
+            # and any error will be reported then.
+            entry.ready.set()
+            return
+
+        with self.lock:
+            discarded = self.closed or self.entries.get(entry.host) is not entry
+            if not discarded:
+                entry.connection = connection
+            entry.ready.set()
+
+        if discarded:
+            connection.close()
+
+    def _prune(self):
+        "Close idle and least recently used connections. Requires the lock."
+        to_close = []
+        expiry = time.time() - self.idle_timeout
+        for host, entry in self.entries.items():
+            if entry.is_idle() and entry.last_used < expiry:
+                to_close.append(self.entries.pop(host))
+
+        for host, entry in self.entries.items():
+            if len(self.entries) <= self.max_size:
+                break
+            if entry.is_idle():
+                to_close.append(self.entries.pop(host))
+
+        return to_close
+
+    def _close_entries(self, entries):
+        for entry in entries:
+            if entry.connection:
+                entry.connection.close()
+
+    def prewarm(self, hosts):
+        "Start connecting to hosts in the background."
+        with self.lock:
+            if self.closed:
+                return
+
+            for host in hosts:
+                if host in self.entries:
+                    continue
+                entry = self.entries[host] = _PooledConnection(host)
+                thread = threading.Thread(target=self._connect_in_background,
+                                          args=(entry,),
+                                          name="push-prewarm-" + host)
+                thread.daemon = True
+                thread.start()
+            to_close = self._prune()
+        self._close_entries(to_close)
+
+    @contextlib.contextmanager
+    def connection(self, host):
+        "Check out the connection to host, connecting first if necessary."
+        with self.lock:
+            entry = self.entries.pop(host, None)
+            if entry is None:
+                entry = _PooledConnection(host)
+                entry.ready.set()
+            entry.users += 1
+            self.entries[host] = entry
+            to_close = self._prune()
+        self._close_entries(to_close)
+
+        try:
+            entry.ready.wait()
+
+            # (re)connect synchronously if there's no usable connection yet
+            # so that connection errors surface to the caller
+            with entry.lock:
+                connection = entry.connection
+                if not connection or not connection.is_active():
+                    if connection:
+                        connection.close()
+                    entry.connection = None
+                    entry.connection = self.connection_class(self.config,
+                                                             self.log, host)
+
+            yield entry.connection
+        finally:
+            with self.lock:
+                entry.users -= 1
+                entry.last_used = time.time()
+
+    def close_all(self):
+        with self.lock:
+            self.closed = True
+            entries = self.entries.values()
+            self.entries.clear()
+        self._close_entries(entries)
 
 
 class SshDeployer(object):
-    """Executes deploy commands on remote systems using SSH. If multiple
-    commands are run on the same host in succession, the same connection is
-    reused for each."""
+    """Executes deploy commands on remote systems using SSH, over the
+    transport selected in the config. Connections are kept in a pool so that
+    commands run on the same host reuse the same connection, and connections
+    to upcoming hosts can be opened ahead of time."""
 
     def __init__(self, config, args, log):
         self.config = config
         self.args = args
         self.log = log
-        self.current_connection = None
+        self.connection_class = TRANSPORTS[config.ssh.transport]
 
+        pool_size = max(config.ssh.pool_size,
+                        args.parallel + config.ssh.prewarm + 1)
+        self.pool = SshConnectionPool(config, log, self.connection_class,
+                                      pool_size, config.ssh.idle_timeout)
+
+        # the build host is used throughout the push, so it gets its own
+        # long-lived connection outside of the pool
+        self.build_connection = None
+        self.build_connection_lock = threading.Lock()
+
+        # called with (host, commands, connect_time, exec_time, output_size)
+        # after each remote invocation, if set
+        self.command_timed = None
+
+        # only paramiko needs the key loaded, ssh reads it itself
         config.ssh.pkey = None
-        if not config.ssh.key_filename:
+        if not config.ssh.key_filename or config.ssh.transport != "paramiko":
             return
 
         key_classes = (paramiko.RSAKey, paramiko.DSSKey)
@@ -115,26 +662,71 @@ class SshDeployer(object):
             raise SshError("invalid password.")
 
     def shutdown(self):
-        if self.current_connection:
-            self.current_connection.close()
-            self.current_connection = None
+        self.pool.close_all()
+
+        with self.build_connection_lock:
+            if self.build_connection:
+                self.build_connection.close()
+                self.build_connection = None
+
+    def prewarm_connections(self, hosts):
+        """Start connecting to hosts that will be pushed to soon so they don't
+        have to wait for the handshake when their turn comes."""
+        build_host = self.config.deploy.build_host
+        hosts = [host for host in hosts if host != build_host]
+        if not self.args.testing and hosts:
+            self.pool.prewarm(hosts)
+
+    @contextlib.contextmanager
+    def _build_host_connection(self):
+        with self.build_connection_lock:
+            connection = self.build_connection
+            if not connection or not connection.is_active():
+                if connection:
+                    self.log.warning("Lost connection to build host. "
+                                     "Reconnecting...")
+                    connection.close()
+                self.build_connection = None
+                self.build_connection = self.connection_class(
+                    self.config, self.log, self.config.deploy.build_host,
+                    keepalive=self.config.ssh.keepalive_interval)
+            connection = self.build_connection
+        yield connection
 
     def _get_connection(self, host):
-        if self.current_connection and self.current_connection.host != host:
-            self.current_connection.close()
-            self.current_connection = None
-        if not self.current_connection:
-            self.current_connection = SshConnection(self.config, self.log, host)
-        return self.current_connection
+        if host == self.config.deploy.build_host:
+            return self._build_host_connection()
+        return self.pool.connection(host)
+
+    def _build_command(self, binary, args):
+        return " ".join(("/usr/bin/sudo", binary) + tuple(args))
+
+    def _command_timed(self, host, commands, started, connected,
+                       output_size):
+        if self.command_timed:
+            self.command_timed(host, commands, connected - started,
+                               time.time() - connected, output_size)
 
     def _run_command(self, host, binary, *args, **kwargs):
-        command = " ".join(("/usr/bin/sudo", binary) + args)
-        self.log.debug(command)
+        command = self._build_command(binary, args)
+        log = self.log.for_host(host)
+        log.debug(command)
 
         if not self.args.testing:
-            conn = self._get_connection(host)
             display_output = kwargs.get("display_output", True)
-            return conn.execute_command(command, display_output=display_output)
+            output = _OutputCollector(log, display_output)
+            started = time.time()
+            with self._get_connection(host) as conn:
+                connected = time.time()
+                try:
+                    status_code = conn.execute_streaming(command, output)
+                finally:
+                    self._command_timed(host, [command], started, connected,
+                                        output.size)
+
+            if status_code != 0:
+                raise SshError(status_code)
+            return output.getvalue()
         else:
             return "TESTING"
 
@@ -147,3 +739,99 @@ class SshDeployer(object):
         return self._run_command(host,
                                  self.config.deploy.deploy_binary,
                                  *args, **kwargs)
+
+    def _run_commands(self, host, binary, commands, display_output,
+                      keep_going):
+        commands = [self._build_command(binary, command)
+                    for command in commands]
+        if not commands:
+            return []
+
+        log = self.log.for_host(host)
+        if self.args.testing:
+            for command in commands:
+                log.debug(command)
+            if keep_going:
+                return [(0, "TESTING")] * len(commands)
+            return ["TESTING"] * len(commands)
+
+        script = CommandScript(log, commands, display_output, keep_going)
+        script.start()
+        started = time.time()
+        with self._get_connection(host) as conn:
+            connected = time.time()
+            try:
+                status_code = conn.execute_streaming(script.render(), script)
+            finally:
+                outputs = script.results() if keep_going else script.finish()
+                self._command_timed(host, commands, started, connected,
+                                    script.size)
+
+        if status_code != 0:
+            raise SshError(status_code)
+        return outputs
+
+    def run_build_commands(self, commands, display_output=True,
+                           keep_going=False):
+        "Like run_deploy_commands, but on the build host."
+        return self._run_commands(self.config.deploy.build_host,
+                                  self.config.deploy.build_binary,
+                                  commands, display_output, keep_going)
+
+    def run_deploy_commands(self, host, commands, display_output=True,
+                            keep_going=False):
+        """Run a sequence of deploy commands on host with a single remote
+        invocation, stopping at the first one that fails. Returns a list of
+        the commands' outputs. If keep_going is set, every command is run
+        regardless and a list of (status code, output) pairs is returned."""
+        return self._run_commands(host, self.config.deploy.deploy_binary,
+                                  commands, display_output, keep_going)
+
+    def _run_command_async(self, host, binary, *args, **kwargs):
+        command = self._build_command(binary, args)
+        log = self.log.for_host(host)
+        log.debug(command)
+
+        if not self.args.testing:
+            display_output = kwargs.get("display_output", True)
+            output = _OutputCollector(log, display_output)
+            return _AsyncRemoteCommand(self, host, command, output,
+                                       output.getvalue, [command])
+        else:
+            return push.engine.Result("TESTING")
+
+    def run_build_command_async(self, *args, **kwargs):
+        """Like run_build_command, but returns an operation for a coroutine
+        running on a push.engine.EventLoop to yield."""
+        return self._run_command_async(self.config.deploy.build_host,
+                                       self.config.deploy.build_binary,
+                                       *args, **kwargs)
+
+    def run_deploy_command_async(self, host, *args, **kwargs):
+        """Like run_deploy_command, but returns an operation for a coroutine
+        running on a push.engine.EventLoop to yield."""
+        return self._run_command_async(host,
+                                       self.config.deploy.deploy_binary,
+                                       *args, **kwargs)
+
+    def run_deploy_commands_async(self, host, commands, display_output=True,
+                                  keep_going=False):
+        """Like run_deploy_commands, but returns an operation for a coroutine
+        running on a push.engine.EventLoop to yield."""
+        commands = [self._build_command(self.config.deploy.deploy_binary,
+                                        command)
+                    for command in commands]
+
+        log = self.log.for_host(host)
+        if self.args.testing or not commands:
+            for command in commands:
+                log.debug(command)
+            if keep_going:
+                return push.engine.Result([(0, "TESTING")] * len(commands))
+            return push.engine.Result(["TESTING"] * len(commands))
+
+        script = CommandScript(log, commands, display_output, keep_going)
+        script.start()
+        result = script.results if keep_going else script.finish
+        return _AsyncRemoteCommand(self, host, script.render(), script,
+                                   result, commands)
@@ -10,17 +10,17 @@ def register(config, args, deployer, log):
 
     syslog.openlog(ident=config.syslog.ident, facility=config.syslog.facility)
 
-    @deployer.push_began
+    @deployer.push_began.background
     def on_push_began(deployer):
         user = getpass.getuser()
         write_syslog('Push %s started by '
                      '%s with args "%s"' % (args.push_id, user,
                                             args.command_line))
 
-    @deployer.push_ended
+    @deployer.push_ended.background
     def on_push_ended(deployer):
         write_syslog("Push %s complete!" % args.push_id)
 
-    @deployer.push_aborted
+    @deployer.push_aborted.background
     def on_push_aborted(deployer, exception):
         write_syslog("Push %s aborted (%s)" % (args.push_id, exception))
@@ -0,0 +1,113 @@
+import collections
+import threading
+
+
+__all__ = ["interleave_domains", "DomainLimiter", "PeerSources"]
+
+
+def interleave_domains(hosts, domains):
+    """Reorder hosts so that consecutive hosts come from different failure
+    domains where possible. domains maps host names to domain names; hosts
+    it doesn't know about are treated as one more domain. Domains take turns
+    in the order they first appear and hosts keep their relative order
+    within their domain."""
+
+    by_domain = collections.OrderedDict()
+    for host in hosts:
+        by_domain.setdefault(domains.get(host), collections.deque()).append(host)
+
+    interleaved = []
+    queues = by_domain.values()
+    while queues:
+        for queue in queues:
+            interleaved.append(queue.popleft())
+        queues = [queue for queue in queues if queue]
+    return interleaved
+
+
+class DomainLimiter(object):
+    """Caps the number of hosts being pushed to at once in each failure
+    domain. Hosts whose domain isn't known aren't limited, nor is anything
+    if max_per_domain is 0."""
+
+    def __init__(self, domains, max_per_domain):
+        self.domains = domains
+        self.max_per_domain = max_per_domain
+        self.in_flight = collections.Counter()
+        self.released = threading.Condition()
+
+    def acquire(self, host):
+        "Claim a slot for host if its domain has one free. Returns success."
+        domain = self.domains.get(host)
+        if not self.max_per_domain or domain is None:
+            return True
+
+        with self.released:
+            if self.in_flight[domain] >= self.max_per_domain:
+                return False
+            self.in_flight[domain] += 1
+            return True
+
+    def release(self, host):
+        domain = self.domains.get(host)
+        if not self.max_per_domain or domain is None:
+            return
+
+        with self.released:
+            self.in_flight[domain] -= 1
+            self.released.notify_all()
+
+    def wait(self, timeout):
+        "Wait for up to timeout seconds for any slot to be released."
+        with self.released:
+            self.released.wait(timeout)
+
+
+class PeerSources(object):
+    """Hosts that already have the code being pushed and can serve it to
+    later hosts, each to at most fan_out hosts at a time. As hosts are
+    pushed to they become sources themselves, so fetches spread out in a
+    tree instead of all going to origin. Nothing is handed out if fan_out
+    is 0."""
+
+    def __init__(self, fan_out):
+        self.fan_out = fan_out
+        self.lock = threading.Lock()
+        self.sources = set()
+        self.failed = set()
+        # one entry per free slot, so sources take turns
+        self.slots = collections.deque()
+
+    def add(self, host):
+        "Make host available as a source."
+        with self.lock:
+            if host in self.sources or host in self.failed:
+                return
+            self.sources.add(host)
+            self.slots.extend([host] * self.fan_out)
+
+    def acquire(self, host):
+        """Claim a slot on a source other than host itself. Returns the
+        source or None if they're all busy."""
+        with self.lock:
+            own_slots = 0
+            while len(self.slots) > own_slots:
+                source = self.slots.popleft()
+                if source in self.failed:
+                    continue
+                if source == host:
+                    self.slots.append(source)
+                    own_slots += 1
+                    continue
+                return source
+            return None
+
+    def release(self, source):
+        with self.lock:
+            if source not in self.failed:
+                self.slots.append(source)
+
+    def discard(self, source):
+        "Stop handing out a source that couldn't be fetched from."
+        with self.lock:
+            self.failed.add(source)
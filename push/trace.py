@@ -0,0 +1,110 @@
+import os
+import json
+import time
+
+import push.waves
+
+
+__all__ = ["register"]
+
+
+# the event_wrapped phases that are timed
+TRACED_PHASES = ("push", "synchronize", "resolve_refs",
+                 "deploy_to_build_host", "build_static",
+                 "restore_static_build", "probe_revisions", "process_wave",
+                 "process_host", "prompt_error")
+
+
+def _describe(args):
+    "Turn a phase's arguments into fields saying what the phase was about."
+    if not args:
+        return {}
+
+    subject = args[0]
+    if isinstance(subject, push.waves.Wave):
+        return dict(wave=subject.number)
+    return dict(host=subject)
+
+
+class TraceWriter(object):
+    """Writes one JSON object per line for each phase of the push, each host
+    and each remote command, with start times and durations in seconds."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "w")
+        self.started = {}
+
+    def write(self, **record):
+        self.file.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def begin(self, phase, args):
+        key = (phase,) + tuple(sorted(_describe(args).items()))
+        self.started[key] = time.time()
+
+    def end(self, phase, args, error=None):
+        fields = _describe(args)
+        key = (phase,) + tuple(sorted(fields.items()))
+        started = self.started.pop(key, None)
+        if started is None:
+            return
+
+        fields.update(type="phase",
+                      phase=phase,
+                      start=started,
+                      duration=time.time() - started,
+                      status="aborted" if error else "ok")
+        if error:
+            fields["error"] = unicode(error)
+        self.write(**fields)
+
+    def command(self, host, commands, connect_time, exec_time, output_size):
+        self.write(type="command",
+                   host=host,
+                   commands=commands,
+                   start=time.time() - connect_time - exec_time,
+                   connect=connect_time,
+                   execute=exec_time,
+                   output_bytes=output_size)
+
+    def close(self):
+        self.file.close()
+
+
+def register(config, args, deployer, log):
+    if not args.trace:
+        return
+
+    trace_path = os.path.splitext(log.log_path)[0] + ".trace"
+    trace = TraceWriter(trace_path)
+
+    def register_phase(phase):
+        @getattr(deployer, phase + "_began")
+        def on_began(deployer, *args):
+            trace.begin(phase, args)
+
+        @getattr(deployer, phase + "_ended")
+        def on_ended(deployer, *args):
+            trace.end(phase, args)
+            if phase == "push":
+                trace.close()
+
+        @getattr(deployer, phase + "_aborted")
+        def on_aborted(deployer, exception, *args):
+            trace.end(phase, args, error=exception)
+            if phase == "push":
+                trace.close()
+
+    for phase in TRACED_PHASES:
+        register_phase(phase)
+
+    @deployer.remote_command_timed
+    def on_remote_command_timed(deployer, host, commands, connect_time,
+                                exec_time, output_size):
+        trace.command(host, commands, connect_time, exec_time, output_size)
+
+    @deployer.push_began
+    def on_push_began(deployer):
+        trace.write(type="push", push_id=args.push_id,
+                    command_line=args.command_line, start=time.time())
+        log.notice("Trace available at %s", trace_path)
@@ -1,21 +1,28 @@
-import hashlib
 import os
-import random
-
+import hashlib
+import tempfile
 
-def get_random_word(config):
-    file_size = os.path.getsize(config.paths.wordlist)
-    word = ""
 
-    with open(config.paths.wordlist, "r") as wordlist:
-        while not word.isalpha() or not word.islower() or len(word) < 5:
-            position = random.randint(1, file_size)
-            wordlist.seek(position)
-            wordlist.readline()
-            word = unicode(wordlist.readline().rstrip("\n"), 'utf-8')
+def seeded_shuffle(seedword, list):
+    list.sort(key=lambda h: hashlib.md5(seedword + h).hexdigest())
 
-    return word
 
+def write_file_atomically(path, data):
+    """Write data to path by way of a temporary file that's renamed into
+    place, so that concurrent pushes never see a partially written file.
+    Raises IOError or OSError if that fails, leaving nothing behind."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
 
-def seeded_shuffle(seedword, list):
-    list.sort(key=lambda h: hashlib.md5(seedword + h).hexdigest())
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(data)
+        os.rename(temp_path, path)
+    except:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,83 @@
+import collections
+import math
+
+import push.utils
+
+
+__all__ = ["Wave", "parse_wave_spec", "plan_waves"]
+
+
+Wave = collections.namedtuple("Wave", "number hosts concurrency")
+Stage = collections.namedtuple("Stage", "size percentage concurrency")
+
+
+def parse_wave_spec(spec):
+    """Parse a wave specification like "1,5%:2,25%:8,*:16" into a list of
+    stages. Each comma-separated stage is a host count, a percentage of the
+    host list or "*" for all remaining hosts, optionally followed by a colon
+    and the number of hosts to push to at once during that stage."""
+
+    stages = []
+    for component in spec.split(","):
+        component = component.strip()
+        if not component:
+            raise ValueError("empty wave in %r" % spec)
+        if stages and stages[-1].size is None:
+            raise ValueError("'*' must be the last wave")
+
+        size, _, concurrency = component.partition(":")
+        if concurrency:
+            concurrency = int(concurrency)
+            if concurrency < 1:
+                raise ValueError("wave concurrency must be at least 1")
+        else:
+            concurrency = None
+
+        if size == "*":
+            stages.append(Stage(None, False, concurrency))
+        elif size.endswith("%"):
+            percentage = float(size[:-1])
+            if not 0 < percentage <= 100:
+                raise ValueError("wave percentage out of range: %r" % size)
+            stages.append(Stage(percentage, True, concurrency))
+        else:
+            count = int(size)
+            if count < 1:
+                raise ValueError("wave must contain at least one host")
+            stages.append(Stage(count, False, concurrency))
+    return stages
+
+
+def plan_waves(seed, hosts, stages, default_concurrency):
+    """Split hosts into waves according to stages. Which hosts land in which
+    wave is decided by a seeded shuffle so the same seed always produces the
+    same plan; within a wave hosts keep their relative order from the host
+    list. Any hosts left over after the last stage form a final wave."""
+
+    shuffled = list(hosts)
+    push.utils.seeded_shuffle(seed, shuffled)
+    position = dict((host, i) for i, host in reversed(list(enumerate(hosts))))
+
+    waves = []
+    offset = 0
+    for stage in stages:
+        if offset >= len(shuffled):
+            break
+
+        if stage.size is None:
+            size = len(shuffled) - offset
+        elif stage.percentage:
+            size = max(int(math.ceil(len(hosts) * stage.size / 100.)), 1)
+        else:
+            size = stage.size
+
+        members = sorted(shuffled[offset:offset + size], key=position.get)
+        offset += len(members)
+        waves.append(Wave(len(waves) + 1, members,
+                          stage.concurrency or default_concurrency))
+
+    if offset < len(shuffled):
+        members = sorted(shuffled[offset:], key=position.get)
+        waves.append(Wave(len(waves) + 1, members, default_concurrency))
+
+    return waves